@@ -16,8 +16,10 @@
 #   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
 #   02111-1307  USA
 
-import ctypes
+import base64, ctypes, hashlib, mmap, multiprocessing, os, re, threading
+import time
 import numpy as np
+from collections import OrderedDict
 from ctypes import *
 
 class Headers:
@@ -67,6 +69,110 @@ class Nodetype:
     CBF_COLUMN      = 6
     CBF_VALUE       = 7
 
+class Compression:
+    """Compression #defines from cbf.h"""
+    CBF_INTEGER     = 0x0010  # Uncompressed integer
+    CBF_FLOAT       = 0x0020  # Uncompressed IEEE floating-point
+    CBF_CANONICAL   = 0x0050  # Canonical compression
+    CBF_PACKED      = 0x0060  # Packed compression
+    CBF_PACKED_V2   = 0x0090  # CCP4 Packed (JPA) compression V2
+    CBF_BYTE_OFFSET = 0x0070  # Byte Offset Compression
+    CBF_PREDICTOR   = 0x0080  # Predictor_Huffman Compression
+    CBF_NONE        = 0x0040  # No compression flag
+    CBF_COMPRESSION_MASK = 0x00FF
+
+class Encoding:
+    """Encoding #defines from cbf.h"""
+    ENC_NONE        = 0x0001  # Use BINARY encoding
+    ENC_BASE64      = 0x0002  # Use BASE64 encoding
+    ENC_BASE32K     = 0x0004  # Use X-BASE32K encoding
+    ENC_QP          = 0x0008  # Use QUOTED-PRINTABLE encoding
+    ENC_BASE10      = 0x0010  # Use BASE10 encoding
+    ENC_BASE16      = 0x0020  # Use BASE16 encoding
+    ENC_BASE8       = 0x0040  # Use BASE8  encoding
+    ENC_FORWARD     = 0x0080  # Map bytes to words forward (1234)
+    ENC_BACKWARD    = 0x0100  # Map bytes to words backward (4321)
+    ENC_CRTERM      = 0x0200  # Terminate lines with CR
+    ENC_LFTERM      = 0x0400  # Terminate lines with LF
+
+class Stats:
+    """Wall clock times, byte counts and counters of reading phases.
+
+    Instrumentation is enabled by setting the module variable `stats` to
+    an instance of this class, e.g. cbf.stats = cbf.Stats(). The timed
+    phases are
+        "fopen" : opening or mapping a file
+        "parse" : parsing a file with cbf_read_file or `binary_sections`
+        "header" : reading headers with `read_header`
+        "arrayparameters" : cbf_get_arrayparameters_wdims
+        "decode" : decoding binary data with CBFlib or Numpy
+        "convert" : converting or copying decoded arrays to other dtypes
+    and the counter "cbflib_calls" counts the calls to CBFlib functions.
+
+    If `callback` is given, it is called as callback(phase, seconds,
+    nbytes) after each timed phase.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all times and counters to zero."""
+        self.times = {}
+        self.nbytes = {}
+        self.calls = {}
+        self.counters = {}
+
+    def add(self, phase, seconds, nbytes=0):
+        """Add a timed phase."""
+        self._lock.acquire()
+        try:
+            self.times[phase] = self.times.get(phase, 0.0) + seconds
+            self.nbytes[phase] = self.nbytes.get(phase, 0) + nbytes
+            self.calls[phase] = self.calls.get(phase, 0) + 1
+        finally:
+            self._lock.release()
+        if self.callback is not None:
+            self.callback(phase, seconds, nbytes)
+
+    def count(self, name, n=1):
+        """Add `n` to counter `name`."""
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self._lock.release()
+
+    def asdict(self):
+        """Return the statistics as a dictionary with keys "times",
+        "nbytes", "calls" and "counters".
+        """
+        self._lock.acquire()
+        try:
+            return {
+                "times" : dict(self.times),
+                "nbytes" : dict(self.nbytes),
+                "calls" : dict(self.calls),
+                "counters" : dict(self.counters),
+                }
+        finally:
+            self._lock.release()
+
+stats = None
+
+
+def _record(phase, t0, nbytes=0):
+    """Add the time since `t0` to `phase` in `stats`, if it is set."""
+    if stats is not None:
+        stats.add(phase, time.time() - t0, nbytes)
+
+
+def _count(n=1):
+    """Count `n` calls to CBFlib in `stats`, if it is set."""
+    if stats is not None:
+        stats.count("cbflib_calls", n)
+
 
 # Interface libc fopen to python
 def io_errcheck(res, func, args):
@@ -83,6 +189,10 @@ c_fopen.errcheck = io_errcheck
 c_fclose = ctypes.pythonapi.fclose
 c_fclose.restype = ctypes.c_int
 c_fclose.argtypes = [FILE_ptr]
+c_fmemopen = ctypes.pythonapi.fmemopen
+c_fmemopen.restype = FILE_ptr
+c_fmemopen.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+c_fmemopen.errcheck = io_errcheck
 
 
 class HandleStruct(Structure): pass # cbf_handle_struct
@@ -91,7 +201,8 @@ Handle = POINTER(HandleStruct) # cbf_handle
 try:
     lib = cdll.LoadLibrary("libcbf.so.0")
 except OSError:
-    lib = cdll.LoadLibrary("/sls/XBL/data/ikonen/cbflib/CBFlib-0.8.1.1/solib/libcbf.so")
+    # Only the "numpy" engine is available without CBFlib
+    lib = None
 
 #lib.cbf_get_arrayparameters_wdims.restype = c_int
 #lib.cbf_get_arrayparameters_wdims.argtypes = [
@@ -114,10 +225,25 @@ except OSError:
 
 class CBF:
     """Create a CBF instance, optionally opening an existing file.
+
+    The `engine` argument sets the default decoder used by `get_binary`,
+    either "cbflib" or "numpy".
+
+    The instance can be reused by reading another file into it, and its
+    CBFlib handle is freed with `close` or at the end of a with block:
+
+    >>> with CBF("testdata/agbeh_long.cbf") as h: #doctest: +SKIP
+    ...     blocks = h.datablocks()
     """
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, engine="cbflib"):
         self.h = Handle()
         self.FILEp = None
+        self.engine = engine
+        self.filename = None
+        self._data = None
+        self._checkpoints = {}
+        if lib is None:
+            raise ImportError("CBFlib (libcbf.so.0) is not available")
         ret = lib.cbf_make_handle(byref(self.h))
         if ret != 0:
             raise RuntimeError(ret)
@@ -126,24 +252,65 @@ class CBF:
 
 
     def __del__(self):
+        # At interpreter shutdown the module globals, including lib, can
+        # already be None, and a failed __init__ leaves no handle.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Free the CBFlib handle and close the associated file.
+
+        The instance can not be used after this.
+        """
+        if not self.h:
+            return
         ret = lib.cbf_free_handle(self.h)
         # CBFlib closes the FILE*
+        self.h = Handle()
+        self.FILEp = None
+        self.filename = None
+        self._data = None
+        self._checkpoints = {}
         if ret != 0:
             raise RuntimeError(ret)
 
+    def reset(self):
+        """Remove all datablocks, closing the associated file.
+
+        The handle is kept and can be used for reading another file.
+        `read_file`, `read_bytes` and `read_fileobj` call this, if a file
+        has been read before.
+        """
+        while self.count_datablocks() > 0:
+            self.rewind_datablock()
+            self.remove_datablock()
+        self.FILEp = None
+        self.filename = None
+        self._data = None
+        self._checkpoints = {}
+
 ####
 #
 #  High level Python API
 
-    def datablocks(self):
+    def datablocks(self, lazy=False):
         """Return a list containing all the datablocks as dictionaries.
 
-        See `datablock_asdict` for the datablock dictionary definition.
+        See `datablock_asdict` for the datablock dictionary definition
+        and `get` for the `lazy` argument.
         """
         self.rewind_datablock()
         blocks = []
         while True:
-            blocks.append(self.datablock_asdict())
+            blocks.append(self.datablock_asdict(lazy=lazy))
             try:
                 self.next_datablock()
             except StopIteration:
@@ -151,7 +318,69 @@ class CBF:
         return blocks
 
 
-    def datablock_asdict(self, key=None):
+    def iter_arrays(self, engine=None, native=False, reuse=False):
+        """Generate the binary values in all datablocks one at a time.
+
+        The generated tuples are (block, category, column, row, array),
+        with the names of the datablock, category and column, the row
+        number and the array from `get_binary` with `engine` and `native`.
+        Only the array being generated is kept in memory by the instance.
+
+        If `reuse` is True, each array is decoded into the same buffer as
+        the previous one, if it has the same shape and dtype, and is thus
+        overwritten by the next. Copy the arrays which must be kept.
+
+        The handle can be used between the iterations, the position of the
+        walk through the datablocks is restored before continuing.
+        """
+        out = None
+        self.rewind_datablock()
+        bi = 0
+        while True:
+            block = self.datablock_name()
+            self.rewind_category()
+            ci = 0
+            while True:
+                category = self.category_name()
+                nrows = self.count_rows()
+                self.rewind_column()
+                coli = 0
+                while True:
+                    column = self.column_name()
+                    for r in range(nrows):
+                        self.select_row(r)
+                        if self.get_typeofvalue() != 'bnry':
+                            continue
+                        if reuse:
+                            p = self.get_arrayparameters()
+                            dtype = binary_dtype(p, native)
+                            if (out is None or out.shape != p["shape"]
+                                    or out.dtype != dtype):
+                                out = np.empty(p["shape"], dtype=dtype)
+                        arr = self.get_binary(engine, native, out=out)
+                        yield block, category, column, r, arr
+                        del arr
+                        self.select_datablock(bi)
+                        self.select_category(ci)
+                        self.select_column(coli)
+                    try:
+                        self.next_column()
+                    except StopIteration:
+                        break
+                    coli += 1
+                try:
+                    self.next_category()
+                except StopIteration:
+                    break
+                ci += 1
+            try:
+                self.next_datablock()
+            except StopIteration:
+                break
+            bi += 1
+
+
+    def datablock_asdict(self, key=None, lazy=False):
         """Return the current datablock as dictionary.
 
         If the argument `key` is None, the current datablock is returned.
@@ -162,7 +391,8 @@ class CBF:
             "name" : name of the datablock
             "categories" : list of categories in the datablock as dictionaries
 
-        See `category_asdict` for category dictionary definition.
+        See `category_asdict` for category dictionary definition
+        and `get` for the `lazy` argument.
         """
         if key is None:
             pass
@@ -177,7 +407,7 @@ class CBF:
         cats = []
         self.rewind_category()
         while True:
-            cats.append(self.category_asdict())
+            cats.append(self.category_asdict(lazy=lazy))
             try:
                 self.next_category()
             except StopIteration:
@@ -186,7 +416,7 @@ class CBF:
         return bd
 
 
-    def category_asdict(self, key=None):
+    def category_asdict(self, key=None, lazy=False, typed=False):
         """Return the current category as dictionary.
 
         If the argument `key` is None, the current category is returned.
@@ -202,7 +432,12 @@ class CBF:
             "values" : dictionary with column names as keys containing lists
                 of the values contained in rows.
 
-        See `get` for the definition of values.
+        See `get` for the definition of values and the `lazy` argument.
+
+        If `typed` is True, the values are read column by column with
+        fewer CBFlib calls, and columns of unquoted values (type "word")
+        which are all integers or numbers are returned as int64 or float64
+        Numpy arrays. Null values ("." and "?") in float columns are NaN.
         """
         if key is None:
             pass
@@ -226,12 +461,20 @@ class CBF:
             coltypes.append(self.get_typeofvalue())
             colvals.append([])
         self.rewind_row()
+        if typed:
+            for c in range(ncols):
+                if coltypes[c] in ("word", "null"):
+                    colvals[c] = _typed_column(self._column_values(c, nrows))
+                elif coltypes[c] != "bnry":
+                    colvals[c] = self._column_values(c, nrows)
         for r in range(nrows):
             self.select_row(r)
             self.rewind_column()
             for c in range(ncols):
+                if typed and coltypes[c] != "bnry":
+                    continue
                 self.select_column(c)
-                val, _ = self.get()
+                val, _ = self.get(lazy=lazy)
                 colvals[c].append(val)
         cd["columns"] = colnames
         cd["columns~type"] = coltypes
@@ -242,11 +485,13 @@ class CBF:
         return cd
 
 
-    def get(self):
+    def get(self, lazy=False):
         """Return the current value as a tuple (value, type).
 
         `value` is either None, an ASCII representation or in the case
-            of a binary value, a Numpy array.
+            of a binary value, a Numpy array. If `lazy` is True, binary
+            values are returned as `LazyArray` placeholders, which are
+            decoded only when accessed.
 
         `type` is a string,
             "null" for a null value,
@@ -261,6 +506,11 @@ class CBF:
         valtype = self.get_typeofvalue()
         if valtype == '':
             return (None, valtype)
+        elif valtype == 'bnry' and lazy:
+            arr = LazyArray(self, self.datablock_name(), self.category_name(),
+                self.column_name(), self.row_number(),
+                self.get_arrayparameters())
+            return (arr, valtype)
         elif valtype == 'bnry':
             arr = self.get_binary()
             return (arr, valtype)
@@ -269,21 +519,107 @@ class CBF:
             return (val, valtype)
 
 
-    def get_binary(self):
+    def get_binary(self, engine=None, native=False, out=None, roi=None,
+            cache=None, verify=False, sparse=False, bin=None, binmode="sum"):
         """Return a binary value as a Numpy array.
 
         The type of the current value must be 'bnry'.
+
+        The array is decoded by CBFlib if `engine` is "cbflib" and by
+        `decode_binary` if `engine` is "numpy". The "mmap" engine is like
+        "numpy", but returns uncompressed arrays as read-only views to
+        the memory-mapped file, without copying. The default is given by
+        the `engine` attribute of the instance.
+
+        Integer arrays are returned as int32 or uint32 and real arrays as
+        float64, unless `native` is True, when the element size in the
+        file is used. If an array `out` with the same number of elements
+        is given, the values are decoded into it, see `binary_dtype`.
+
+        If `roi` is given, only the region `arr[roi]` of the array is
+        decoded by `decode_binary`, independent of `engine`. The first
+        read of a region from a byte offset compressed binary decodes the
+        array up to the last row of the region. The second read decodes
+        the whole array to find the checkpoints at the start of each row,
+        which are kept for the next reads from the same file.
+
+        If a `FrameCache` is given as `cache`, the array is taken from it
+        if it has been read before from the same file, unchanged since,
+        and verified if `verify` is True. Values of files read from
+        memory are not cached.
+
+        If `verify` is True, the Content-MD5 of the binary is checked in
+        a background thread while decoding, see `decode_binary`.
+
+        If `sparse` is True, the nonzero elements are returned as a
+        `SparseFrame` from `decode_sparse`, independent of `engine`,
+        without creating the dense array.
+
+        If `bin` = (rows, columns) is given, blocks of pixels are summed
+        or averaged according to `binmode` ("sum" or "mean") while
+        decoding with `decode_binned`, independent of `engine`, and only
+        the binned array is created.
         """
         valtype = self.get_typeofvalue()
         if valtype != 'bnry':
             raise ValueError("Not a binary value")
+        if sparse:
+            p = self.get_arrayparameters()
+            return decode_sparse(self._raw(), self._section(p["id"]),
+                binary_dtype(p, native), verify=verify)
+        if cache is not None and self.filename is not None:
+            key = cache.key(self.filename, self.datablock_name(),
+                self.category_name(), self.column_name(), self.row_number(),
+                native, repr(roi), bin, binmode, verify)
+            return _cached(cache, key,
+                lambda: self.get_binary(engine, native, roi=roi,
+                    verify=verify, bin=bin, binmode=binmode), out)
+        if verify:
+            sect = self._section(self.get_arrayparameters()["id"])
+            res = _verify_pool().apply_async(check_md5, (self._raw(), sect))
+            arr = self.get_binary(engine, native, out, roi, bin=bin,
+                binmode=binmode)
+            if res.get() is False:
+                raise RuntimeError(Errors.CBF_FORMAT)
+            return arr
+        if engine is None:
+            engine = self.engine
         p = self.get_arrayparameters()
-        if p["elunsigned"]:
-            arr = self.get_integerarray(p["shape"], elsigned=False)
-        elif p["elsigned"]:
-            arr = self.get_integerarray(p["shape"], elsigned=True)
+        if bin is not None:
+            return decode_binned(self._raw(), self._section(p["id"]), bin,
+                binmode, out)
+        if roi is not None:
+            sect = self._section(p["id"])
+            key = (sect["datablock"], sect["id"])
+            # Checkpoints are found when a region is read the second time
+            if key in self._checkpoints and self._checkpoints[key] is None:
+                self._checkpoints[key] = binary_checkpoints(self._raw(), sect)
+            else:
+                self._checkpoints.setdefault(key, None)
+            return decode_binary(self._raw(), sect,
+                dtype=binary_dtype(p, native), out=out, roi=roi,
+                checkpoints=self._checkpoints[key])
+        if engine == "numpy":
+            return decode_binary(self._raw(), self._section(p["id"]),
+                dtype=binary_dtype(p, native), out=out)
+        elif engine == "mmap":
+            return decode_binary(self._raw(), self._section(p["id"]),
+                copy=False, dtype=binary_dtype(p, native), out=out)
+        elif engine != "cbflib":
+            raise ValueError("Unknown engine: %s" % str(engine))
+        dtype = binary_dtype(p, native)
+        if out is not None and out.dtype.kind != dtype.kind:
+            arr = self.get_binary("cbflib", native)
+            t0 = time.time()
+            out[...] = arr.reshape(out.shape)
+            _record("convert", t0, out.nbytes)
+            return out
+        if dtype.kind == "f":
+            arr = self.get_realarray(p["shape"], elsize=dtype.itemsize,
+                out=out)
         else:
-            arr = self.get_realarray(p["shape"])
+            arr = self.get_integerarray(p["shape"], elsigned=dtype.kind == "i",
+                elsize=dtype.itemsize, out=out)
         return arr
 
 
@@ -291,12 +627,14 @@ class CBF:
 #
 #   Helper functions for lower level Python API
 
-    def _check(self, f):
-        ret = f(self.h)
+    def _check(self, f, *args):
+        _count()
+        ret = f(self.h, *args)
         if ret != 0:
             raise RuntimeError(ret)
 
     def _get_str(self, f):
+        _count()
         val = c_char_p()
         ret = f(self.h, byref(val))
         if ret != 0:
@@ -306,7 +644,46 @@ class CBF:
         else:
             return val.value
 
+    def _raw(self):
+        """Return the raw contents of the current file as a string or
+        a read-only mmap object.
+        """
+        if self._data is None:
+            self._data = map_file(self.filename)
+        return self._data
+
+    def _section(self, binary_id):
+        """Return the parameters of the binary section `binary_id` in
+        the current datablock, as found by `binary_sections`.
+        """
+        block = self.datablock_name()
+        for p in binary_sections(self._raw()):
+            if p["datablock"] == block and p["id"] == binary_id:
+                return p
+        raise KeyError(binary_id)
+
+    def _column_values(self, column, nrows):
+        """Return the ASCII values of a column of non-binary values as a list.
+
+        Null values are returned as None.
+        """
+        self.select_column(column)
+        self.rewind_row()
+        h = self.h
+        val = c_char_p()
+        pval = byref(val)
+        select_row, get_value = lib.cbf_select_row, lib.cbf_get_value
+        vals = []
+        for r in range(nrows):
+            ret = select_row(h, c_uint(r)) or get_value(h, pval)
+            if ret != 0:
+                raise RuntimeError(ret)
+            vals.append(val.value)
+        _count(2*nrows)
+        return vals
+
     def _get_int(self, f):
+        _count()
         val = c_int()
         ret = f(self.h, byref(val))
         if ret != 0:
@@ -321,12 +698,74 @@ class CBF:
     def read_file(self, filename):
         """Associate an existing file to a CBF instance.
         """
+        if self.FILEp is not None:
+            self.reset()
+        t0 = time.time()
         self.FILEp = c_fopen(filename, 'rb')
+        _record("fopen", t0)
+        t0 = time.time()
+        _count()
         ret = lib.cbf_read_file(self.h, self.FILEp, c_int(Headers.MSG_NODIGEST))
         if ret != 0:
-            c_fclose(self.FILEp)
+            # CBFlib has closed the stream
+            self.FILEp = None
             raise RuntimeError(ret)
+        if stats is not None:
+            _record("parse", t0, os.path.getsize(filename))
         self.filename = filename
+        self._data = None
+        self._checkpoints = {}
+
+    def read_bytes(self, buf):
+        """Associate the CBF file contents in a string or a buffer to a
+        CBF instance.
+
+        The contents are read by CBFlib with libc fmemopen without writing
+        them to a file. Objects other than strings are copied to a string,
+        which is kept alive as long as the instance refers to it.
+        """
+        if not isinstance(buf, bytes):
+            buf = memoryview(buf).tobytes()
+        if self.FILEp is not None:
+            self.reset()
+        t0 = time.time()
+        self.FILEp = c_fmemopen(buf, len(buf), 'rb')
+        _record("fopen", t0)
+        t0 = time.time()
+        _count()
+        ret = lib.cbf_read_file(self.h, self.FILEp, c_int(Headers.MSG_NODIGEST))
+        if ret != 0:
+            # CBFlib has closed the stream
+            self.FILEp = None
+            raise RuntimeError(ret)
+        _record("parse", t0, len(buf))
+        self.filename = None
+        self._data = buf
+        self._checkpoints = {}
+
+    def read_fileobj(self, f):
+        """Associate a CBF file read from a file-like object `f` to a CBF
+        instance.
+
+        The object can be for example a gzip.GzipFile or a bz2.BZ2File,
+        see `read_bytes`. Like with `read_bytes`, the `filename` attribute
+        is None, so that values are not cached by the file name.
+        """
+        self.read_bytes(f.read())
+
+# Removes
+
+    def remove_datablock(self):
+        self._check(lib.cbf_remove_datablock)
+
+    def remove_category(self):
+        self._check(lib.cbf_remove_category)
+
+    def remove_column(self):
+        self._check(lib.cbf_remove_column)
+
+    def remove_row(self):
+        self._check(lib.cbf_remove_row)
 
 # Rewinds
 
@@ -353,6 +792,7 @@ class CBF:
     def _next(self, f):
         """Calls `f`, potentially raising either StopIteration or RuntimeError.
         """
+        _count()
         ret = f(self.h)
         if ret == Errors.CBF_NOTFOUND:
             raise StopIteration()
@@ -386,6 +826,7 @@ class CBF:
 # Finds
 
     def _find(self, f, name):
+        _count()
         ret = f(self.h, name)
         if ret == Errors.CBF_NOTFOUND:
             raise KeyError()
@@ -430,6 +871,7 @@ class CBF:
 # Selects
 
     def _select(self, f, index):
+        _count()
         cind = c_uint(index)
         ret = f(self.h, cind)
         if ret == Errors.CBF_NOTFOUND:
@@ -476,6 +918,14 @@ class CBF:
     def column_name(self):
         return self._get_str(lib.cbf_column_name)
 
+# Numbers
+
+    def row_number(self):
+        return self._get_int(lib.cbf_row_number)
+
+    def column_number(self):
+        return self._get_int(lib.cbf_column_number)
+
 # Gets
 
     def get_arrayparameters(self):
@@ -504,6 +954,8 @@ class CBF:
         byteorder = c_char_p()
         dimfast, dimmid, dimslow = c_size_t(), c_size_t(), c_size_t()
         padding = c_size_t()
+        t0 = time.time()
+        _count()
         ret = lib.cbf_get_arrayparameters_wdims(self.h, byref(compression),
             byref(binary_id), byref(elsize), byref(elsigned),
             byref(elunsigned), byref(nelem), byref(minelem), byref(maxelem),
@@ -511,6 +963,7 @@ class CBF:
             byref(dimslow), byref(padding))
         if ret != 0:
             raise RuntimeError(ret)
+        _record("arrayparameters", t0)
         if dimslow.value != 0:
             # Numpy array order
             shape = (dimslow.value, dimmid.value, dimfast.value)
@@ -536,37 +989,69 @@ class CBF:
                 }
 
 
-    def get_integerarray(self, shape, elsigned=1):
+    def get_integerarray(self, shape, elsigned=1, elsize=4, out=None):
         """Return the current integer array as a Numpy array.
+
+        The elements are read as `elsize` byte integers, signed if
+        `elsigned` is true. If `out` is given, the array is read into it
+        and returned, and the element type is given by its dtype.
+        Non-contiguous `out` arrays are filled through a temporary array.
         """
         binary_id = c_int()
         elread = c_size_t()
-        if elsigned:
-            dtype = 'int32'
-        else:
-            dtype = 'uint32'
-        arr = np.zeros(shape, dtype=dtype)
-        nelems = np.prod(shape)
+        if out is not None:
+            if out.dtype.kind not in "iu":
+                raise TypeError("Output array must have an integer dtype")
+            elsigned = int(out.dtype.kind == "i")
+            elsize = out.dtype.itemsize
+        dtype = np.dtype("%s%d" % ("i" if elsigned else "u", elsize))
+        arr = _contiguous_out(shape, dtype, out)
+        nelems = arr.size
+        t0 = time.time()
+        _count()
         ret = lib.cbf_get_integerarray(self.h, byref(binary_id),
             arr.ctypes.get_as_parameter(),
-            4, elsigned, c_size_t(nelems), byref(elread))
-        if ret != 0 or elread != nelems:
+            c_size_t(elsize), c_int(elsigned), c_size_t(nelems),
+            byref(elread))
+        if ret != 0 or elread.value != nelems:
             raise RuntimeError(ret)
+        _record("decode", t0, arr.nbytes)
+        if out is not None and arr is not out:
+            t0 = time.time()
+            out[...] = arr.reshape(out.shape)
+            _record("convert", t0, out.nbytes)
+            return out
         return arr
 
 
-    def get_realarray(self, shape):
+    def get_realarray(self, shape, elsize=8, out=None):
         """Return the current real array as a Numpy array.
+
+        The elements are read as `elsize` byte floats. If `out` is given,
+        the array is read into it and returned, and the element type is
+        given by its dtype.
         """
         binary_id = c_int()
         elread = c_size_t()
-        arr = np.zeros(shape, dtype=np.float64)
-        nelems = np.prod(shape)
+        if out is not None:
+            if out.dtype.kind != "f":
+                raise TypeError("Output array must have a float dtype")
+            elsize = out.dtype.itemsize
+        arr = _contiguous_out(shape, np.dtype("f%d" % elsize), out)
+        nelems = arr.size
+        t0 = time.time()
+        _count()
         ret = lib.cbf_get_realarray(self.h, byref(binary_id),
             arr.ctypes.get_as_parameter(),
-            8, nelems, byref(elread))
-        if ret != 0 or elread != nelems:
+            c_size_t(elsize), c_size_t(nelems), byref(elread))
+        if ret != 0 or elread.value != nelems:
             raise RuntimeError(ret)
+        _record("decode", t0, arr.nbytes)
+        if out is not None and arr is not out:
+            t0 = time.time()
+            out[...] = arr.reshape(out.shape)
+            _record("convert", t0, out.nbytes)
+            return out
         return arr
 
 
@@ -589,6 +1074,7 @@ class CBF:
         The type of the value must not be 'bnry', otherwise a ValueError
         is raised.
         """
+        _count()
         val = c_char_p()
         ret = lib.cbf_get_value(self.h, byref(val))
         if ret == Errors.CBF_BINARY:
@@ -597,3 +1083,1646 @@ class CBF:
             raise RuntimeError(ret)
         return val.value
 
+# Writing
+
+    def write_file(self, filename,
+            headers=Headers.MIME_HEADERS|Headers.MSG_DIGEST|Headers.PAD_4K,
+            encoding=Encoding.ENC_NONE|Encoding.ENC_CRTERM|Encoding.ENC_LFTERM):
+        """Write the contents of a CBF instance to a file.
+
+        The defaults for `headers` and `encoding` produce files like the
+        ones written by Pilatus detectors. CBFlib closes the file.
+        """
+        FILEp = c_fopen(filename, 'wb')
+        ret = lib.cbf_write_file(self.h, FILEp, c_int(0), c_int(0),
+            c_int(headers), c_int(encoding))
+        if ret != 0:
+            raise RuntimeError(ret)
+
+    def new_datablock(self, name):
+        self._check(lib.cbf_new_datablock, name)
+
+    def new_category(self, name):
+        self._check(lib.cbf_new_category, name)
+
+    def new_column(self, name):
+        self._check(lib.cbf_new_column, name)
+
+    def new_row(self):
+        self._check(lib.cbf_new_row)
+
+    def set_value(self, value):
+        """Set the current value to the string `value`."""
+        self._check(lib.cbf_set_value, value)
+
+    def set_typeofvalue(self, valtype):
+        """Set the type of the current value, see `get_typeofvalue`."""
+        self._check(lib.cbf_set_typeofvalue, valtype)
+
+    def set_integerarray(self, arr, compression=Compression.CBF_BYTE_OFFSET,
+            binary_id=1, padding=0):
+        """Set the current value to the integer Numpy array `arr`.
+
+        The array is written with its own element size and signedness,
+        up to 3 dimensions.
+        """
+        if arr.dtype.kind not in "iu" or arr.ndim > 3:
+            raise TypeError("Expecting an integer array with ndim <= 3")
+        arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder("<"))
+        dims = list(arr.shape[::-1]) + [0]*(3 - arr.ndim)
+        ret = lib.cbf_set_integerarray_wdims(self.h, c_uint(compression),
+            c_int(binary_id), arr.ctypes.get_as_parameter(),
+            c_size_t(arr.itemsize), c_int(arr.dtype.kind == "i"),
+            c_size_t(arr.size), c_char_p("little_endian"),
+            c_size_t(dims[0]), c_size_t(dims[1]), c_size_t(dims[2]),
+            c_size_t(padding))
+        if ret != 0:
+            raise RuntimeError(ret)
+
+    def set_realarray(self, arr, compression=Compression.CBF_NONE,
+            binary_id=1, padding=0):
+        """Set the current value to the float Numpy array `arr`."""
+        if arr.dtype.kind != "f" or arr.ndim > 3:
+            raise TypeError("Expecting a float array with ndim <= 3")
+        arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder("<"))
+        dims = list(arr.shape[::-1]) + [0]*(3 - arr.ndim)
+        ret = lib.cbf_set_realarray_wdims(self.h, c_uint(compression),
+            c_int(binary_id), arr.ctypes.get_as_parameter(),
+            c_size_t(arr.itemsize), c_size_t(arr.size),
+            c_char_p("little_endian"),
+            c_size_t(dims[0]), c_size_t(dims[1]), c_size_t(dims[2]),
+            c_size_t(padding))
+        if ret != 0:
+            raise RuntimeError(ret)
+
+
+
+def _typed_column(vals):
+    """Return a list of strings as an int64 or float64 Numpy array, or
+    unchanged, if the strings are not numbers.
+    """
+    try:
+        return np.array([int(v) for v in vals], dtype=np.int64)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return np.array([np.nan if v in (None, ".", "?") else float(v)
+            for v in vals], dtype=np.float64)
+    except (TypeError, ValueError):
+        return vals
+
+
+def _contiguous_out(shape, dtype, out):
+    """Return `out` if it can be written by a decoder as a C-contiguous
+    array, otherwise a new empty array.
+    """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.size != int(np.prod(shape)):
+        raise ValueError("Output array has a wrong number of elements")
+    if out.flags.c_contiguous and out.flags.writeable and out.dtype == dtype:
+        return out
+    return np.empty(shape, dtype=dtype)
+
+
+class LazyArray:
+    """Placeholder for a binary value, which is decoded when accessed.
+
+    The value is decoded with `CBF.get_binary` from the CBF instance
+    `handle` on the first call to `decode`, when converted to a Numpy
+    array with numpy.asarray() or when an attribute of the array is
+    accessed. Decoding moves the current position in `handle`.
+
+    The decoded array is kept if the attribute `cache` is True, and can
+    be dropped with `release`. The array parameters from
+    `CBF.get_arrayparameters` are in the attribute `params`.
+    """
+    def __init__(self, handle, datablock, category, column, row, params,
+            cache=True):
+        self.handle = handle
+        self.datablock = datablock
+        self.category = category
+        self.column = column
+        self.row = row
+        self.params = params
+        self.cache = cache
+        self._value = None
+
+    def decode(self):
+        """Return the value as a Numpy array."""
+        if self._value is not None:
+            return self._value
+        h = self.handle
+        h.find_datablock(self.datablock)
+        h.find_category(self.category)
+        h.find_column(self.column)
+        h.select_row(self.row)
+        arr = h.get_binary()
+        if self.cache:
+            self._value = arr
+        return arr
+
+    def release(self):
+        """Drop the decoded array."""
+        self._value = None
+
+    def __array__(self, dtype=None):
+        arr = self.decode()
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.decode(), name)
+
+    def __len__(self):
+        return self.params["shape"][0]
+
+    def __getitem__(self, key):
+        return self.decode()[key]
+
+    def __repr__(self):
+        return "<LazyArray %s.%s[%d] shape=%s>" % (self.category,
+            self.column, self.row, str(self.params["shape"]))
+
+
+####
+#
+#   Pure NumPy engine
+
+BINARY_START = b"--CIF-BINARY-FORMAT-SECTION--"
+BINARY_MARKER = b"\x0c\x1a\x04\xd5"
+
+_conversions = {
+    "x-CBF_NONE" : Compression.CBF_NONE,
+    "x-CBF_BYTE_OFFSET" : Compression.CBF_BYTE_OFFSET,
+    "x-CBF_PACKED" : Compression.CBF_PACKED,
+    "x-CBF_PACKED_V2" : Compression.CBF_PACKED_V2,
+    "x-CBF_CANONICAL" : Compression.CBF_CANONICAL,
+    "x-CBF_PREDICTOR" : Compression.CBF_PREDICTOR,
+}
+
+_mime_re = re.compile(br"^([A-Za-z0-9-]+):[ \t]*(.*)$")
+_conversions_re = re.compile(br'conversions="?([A-Za-z0-9_-]+)"?')
+_eltype_re = re.compile(br'"?(signed|unsigned) (\d+)-bit (integer|real IEEE)')
+_datablock_re = re.compile(br"(?:^|\n)data_(\S*)")
+
+
+def _str(b):
+    """Return the byte string `b` as a native string."""
+    if isinstance(b, str):
+        return b
+    return b.decode("latin-1")
+
+
+def _parse_mime(header):
+    """Return a dictionary of MIME header fields with lowercase keys."""
+    fields = {}
+    key = None
+    for line in header.splitlines():
+        if line[:1] in (b" ", b"\t") and key is not None:
+            fields[key] = fields[key] + b" " + line.strip()
+            continue
+        mob = _mime_re.match(line)
+        if mob is not None:
+            key = mob.group(1).lower()
+            fields[key] = mob.group(2).strip()
+    return fields
+
+
+def binary_sections(buf):
+    """Generate the parameters of each binary section in the CBF file `buf`.
+
+    `buf` is the raw file content as a string, buffer or mmap object.
+    The generated dictionaries have the same keys as the dictionary from
+    `CBF.get_arrayparameters` (except "minelem" and "maxelem") with these
+    additional keys:
+        "datablock" : name of the datablock containing the section
+        "size" : Size of the binary data in bytes
+        "md5" : Content-MD5 of the section or None
+        "offset" : Offset of the binary data from the start of `buf`
+    """
+    pos = 0
+    block = ""
+    while True:
+        start = buf.find(BINARY_START, pos)
+        if start < 0:
+            return
+        if buf[start+len(BINARY_START):start+len(BINARY_START)+2] == b"--":
+            # End of a section
+            pos = start + len(BINARY_START) + 2
+            continue
+        names = _datablock_re.findall(buf[pos:start])
+        if names:
+            block = _str(names[-1])
+        marker = buf.find(BINARY_MARKER, start)
+        if marker < 0:
+            raise RuntimeError(Errors.CBF_FORMAT)
+        fields = _parse_mime(buf[start+len(BINARY_START):marker])
+        mob = _conversions_re.search(fields.get(b"content-type", b""))
+        if mob is None:
+            compression = Compression.CBF_NONE
+        else:
+            compression = _conversions.get(_str(mob.group(1)), 0)
+        mob = _eltype_re.match(fields.get(b"x-binary-element-type",
+            b"signed 32-bit integer"))
+        if mob is None:
+            raise RuntimeError(Errors.CBF_FORMAT)
+        elsigned = int(mob.group(1) == b"signed")
+        realarray = int(mob.group(3) != b"integer")
+        dims = [int(fields.get(b"x-binary-size-" + k + b"-dimension", 0))
+            for k in (b"third", b"second", b"fastest")]
+        nelem = int(fields.get(b"x-binary-number-of-elements", 0))
+        shape = tuple(d for d in dims if d != 0) or (nelem,)
+        order = fields.get(b"x-binary-element-byte-order", b"LITTLE_ENDIAN")
+        md5 = fields.get(b"content-md5")
+        size = int(fields[b"x-binary-size"])
+        offset = marker + len(BINARY_MARKER)
+        yield {
+                "datablock" : block,
+                "compression" : compression,
+                "id" : int(fields.get(b"x-binary-id", 1)),
+                "elsize" : int(mob.group(2)) // 8,
+                "elsigned" : int(elsigned and not realarray),
+                "elunsigned" : int(not elsigned and not realarray),
+                "nelem" : nelem,
+                "realarray" : realarray,
+                "byteorder" : _str(order).lower(),
+                "shape" : shape,
+                "padding" : int(fields.get(b"x-binary-size-padding", 0)),
+                "size" : size,
+                "md5" : md5 and _str(md5),
+                "offset" : offset,
+                }
+        pos = offset + size
+
+
+def _gather(raw, starts, size, dtype):
+    """Return the values of `dtype` in `size` bytes of the uint8 array
+    `raw` at positions `starts`. Bytes past the end of `raw` are
+    replaced by its last byte.
+    """
+    idx = starts[:,None] + np.arange(size)
+    np.minimum(idx, len(raw) - 1, out=idx)
+    return raw[idx].view(dtype).reshape(-1)
+
+
+def _byte_offset_escapes(raw, order="<", partial=False):
+    """Return positions, lengths and values of the multibyte tokens in
+    an x-CBF_BYTE_OFFSET compressed uint8 array `raw`.
+
+    Payload bytes of a multibyte token can also have the escape value
+    0x80. A candidate 0x80 byte is an escape, if it is not inside the
+    token of an earlier candidate, or if it is reached by following the
+    tokens from the start of a run of overlapping candidates. The
+    tokens in all runs are followed at the same time by doubling the
+    jumps, so the number of steps grows with the logarithm of the
+    length of the longest run.
+    If `partial` is True, `raw` can end in the middle of a token, which
+    is then left out.
+    """
+    n = len(raw)
+    cands = np.flatnonzero(raw == 0x80)
+    m = len(cands)
+    lo = raw[np.minimum(cands + 1, n - 1)].astype(np.int16)
+    hi = raw[np.minimum(cands + 2, n - 1)].astype(np.int16)
+    if order != "<":
+        lo, hi = hi, lo
+    vals = (lo | (hi << 8)).astype(np.int64)
+    lens = np.empty(m, dtype=np.intp)
+    lens.fill(3)
+    w = np.flatnonzero(vals == -0x8000)
+    if len(w):
+        lens[w] = 7
+        v32 = _gather(raw, cands[w] + 3, 4, order + "i4")
+        vals[w] = v32
+        w = w[v32 == -0x80000000]
+        if len(w):
+            lens[w] = 15
+            vals[w] = _gather(raw, cands[w] + 7, 8, order + "i8")
+    ends = cands + lens
+    # Candidates after the tokens of all earlier candidates start runs
+    starts = np.ones(m + 1, dtype=bool)
+    if m > 1:
+        starts[1:m] = cands[1:] >= np.maximum.accumulate(ends[:-1])
+    real = starts.copy()
+    # Candidates in runs of more than one
+    sub = np.flatnonzero(~(starts[:m] & starts[1:]))
+    if len(sub):
+        # Next candidate after each token in the run, len(sub) at the end
+        k = len(sub)
+        nxt = np.searchsorted(cands, ends[sub])
+        jump = np.empty(k + 1, dtype=np.intp)
+        jump[:k] = np.searchsorted(sub, nxt)
+        jump[:k][starts[nxt]] = k
+        jump[k] = k
+        reached = np.append(starts[sub], True)
+        while True:
+            tgt = jump[reached]
+            if reached[tgt].all():
+                break
+            reached[tgt] = True
+            jump = jump[jump]
+        real[sub] = reached[:k]
+    real = np.flatnonzero(real[:m])
+    pos, lens, vals = cands[real], lens[real], vals[real]
+    if len(pos) and pos[-1] + lens[-1] > n:
+        if not partial:
+            raise RuntimeError(Errors.CBF_FORMAT)
+        pos, lens, vals = pos[:-1], lens[:-1], vals[:-1]
+    return pos, lens, vals
+
+
+def _byte_offset_deltas(data, dtype, byteorder="<", partial=False):
+    """Return the deltas of x-CBF_BYTE_OFFSET compressed `data` as an
+    array of `dtype` and a boolean array, which is True at the first
+    byte of each delta in `data`. See `_byte_offset_escapes` for
+    `partial`.
+    """
+    if isinstance(data, np.ndarray):
+        raw = data.view(np.uint8)
+    else:
+        raw = np.frombuffer(data, dtype=np.uint8)
+    pos, lens, vals = _byte_offset_escapes(raw, byteorder, partial)
+    keep = np.ones(len(raw), dtype=bool)
+    keep[pos+1] = False
+    keep[pos+2] = False
+    # Payload bytes after the first three of the long tokens
+    extra = lens[lens > 3] - 3
+    if len(extra):
+        first = pos[lens > 3] + 3 - np.cumsum(extra) + extra
+        keep[np.repeat(first, extra) + np.arange(extra.sum())] = False
+    deltas = raw.view(np.int8)[keep].astype(dtype)
+    # Escape positions in the array with payload bytes removed
+    skipped = np.cumsum(lens - 1) - (lens - 1)
+    deltas[pos - skipped] = vals.astype(dtype)
+    return deltas, keep
+
+
+def decode_byte_offset(data, nelem, dtype=np.int32, out=None, byteorder="<",
+        initial=0):
+    """Decode x-CBF_BYTE_OFFSET compressed `data` to a flat Numpy array.
+
+    `data` is a string, buffer or an uint8 Numpy array. The deltas are
+    decoded with vectorized Numpy operations and summed with `cumsum`
+    directly into `out`, which must be a C-contiguous array with `nelem`
+    elements, if given. The deltas are added to `initial`, which is the
+    value of the element before `data` when decoding a part of an array
+    starting from a checkpoint, see `byte_offset_index`.
+    """
+    if out is None:
+        out = np.empty(nelem, dtype=dtype)
+    elif not out.flags.c_contiguous:
+        raise ValueError("Output array must be C-contiguous")
+    flat = out.reshape(-1)
+    deltas, keep = _byte_offset_deltas(data, flat.dtype, byteorder)
+    if len(deltas) != nelem or flat.size != nelem:
+        raise RuntimeError(Errors.CBF_FORMAT)
+    if initial and nelem:
+        deltas[0] += initial
+    np.cumsum(deltas, dtype=flat.dtype, out=flat)
+    return out
+
+
+def byte_offset_index(data, nelem, rowlen, byteorder="<"):
+    """Return a checkpoint index of x-CBF_BYTE_OFFSET compressed `data`.
+
+    The index is an int64 array of shape (2, nrows+1), where nrows is
+    `nelem` // `rowlen`. The first row has the byte position in `data`
+    of the start of each row of `rowlen` elements and the end of the
+    data, the second row the value of the element before the start
+    (0 for the first row). Rows `i` to `j` can then be decoded without
+    the rest of the data with
+
+    >>> decode_byte_offset(data[ind[0,i]:ind[0,j]], (j-i)*rowlen,
+    ...     initial=ind[1,i]) #doctest: +SKIP
+    """
+    deltas, keep = _byte_offset_deltas(data, np.int64, byteorder)
+    if len(deltas) != nelem or nelem % rowlen:
+        raise RuntimeError(Errors.CBF_FORMAT)
+    starts = np.flatnonzero(keep)
+    ind = np.zeros((2, nelem // rowlen + 1), dtype=np.int64)
+    ind[0,:-1] = starts[::rowlen]
+    ind[0,-1] = len(keep)
+    ind[1,1:] = np.cumsum(deltas)[rowlen-1::rowlen]
+    return ind
+
+
+def encode_byte_offset(arr):
+    """Return the Numpy array `arr` as x-CBF_BYTE_OFFSET compressed string.
+
+    The deltas are computed and written with vectorized Numpy operations.
+    Multibyte deltas are little endian.
+    """
+    flat = np.asarray(arr).reshape(-1).astype(np.int64)
+    deltas = np.empty_like(flat)
+    if len(flat):
+        deltas[0] = flat[0]
+        np.subtract(flat[1:], flat[:-1], out=deltas[1:])
+    lens = np.ones(len(deltas), dtype=np.intp)
+    absd = np.abs(deltas)
+    lens[(absd > 127) | (deltas == -128)] = 3
+    lens[(absd > 0x7fff) | (deltas == -0x8000)] = 7
+    lens[(absd > 0x7fffffff) | (deltas == -0x80000000)] = 15
+    offsets = np.cumsum(lens) - lens
+    out = np.empty(int(lens.sum()), dtype=np.uint8)
+    small = lens == 1
+    out[offsets[small]] = deltas[small].astype(np.uint8)
+    # Escape bytes and the values of the escaped deltas
+    for l, escapes, nbytes in [(3, 1, 2), (7, 3, 4), (15, 7, 8)]:
+        sel = lens == l
+        if not np.any(sel):
+            continue
+        off = offsets[sel]
+        vals = deltas[sel]
+        out[off] = 0x80
+        if escapes > 1:
+            out[off+1] = 0x00
+            out[off+2] = 0x80
+        if escapes > 3:
+            out[off+3] = 0x00
+            out[off+4] = 0x00
+            out[off+5] = 0x00
+            out[off+6] = 0x80
+        for k in range(nbytes):
+            out[off+escapes+k] = (vals >> (8*k)) & 0xff
+    return out.tobytes()
+
+
+_frame_template = "\r\n".join([
+    "###CBF: VERSION 1.5, CBF-ctypes",
+    "",
+    "data_%(name)s",
+    "",
+    '_array_data.header_convention "%(convention)s"',
+    "_array_data.header_contents",
+    ";",
+    "%(contents)s",
+    ";",
+    "",
+    "_array_data.data",
+    ";",
+    "--CIF-BINARY-FORMAT-SECTION--",
+    "Content-Type: application/octet-stream;",
+    '     conversions="%(conversions)s"',
+    "Content-Transfer-Encoding: BINARY",
+    "X-Binary-Size: %(size)d",
+    "X-Binary-ID: 1",
+    'X-Binary-Element-Type: "%(eltype)s"',
+    "X-Binary-Element-Byte-Order: LITTLE_ENDIAN",
+    "Content-MD5: %(md5)s",
+    "X-Binary-Number-of-Elements: %(nelem)d",
+    "%(dims)s",
+    "X-Binary-Size-Padding: %(padding)d",
+    "",
+    ""])
+
+
+def write_frame(filename, arr, header="", name="image", engine="numpy",
+        convention="SLS_1.0", padding=4095, compressed=True):
+    """Write a 1 to 3 dimensional Numpy array to a miniCBF file.
+
+    `header` is the text written to _array_data.header_contents, e.g.
+    the Pilatus header lines. Integer arrays are written with
+    x-CBF_BYTE_OFFSET compression, unless `compressed` is False, and
+    float arrays uncompressed.
+
+    With the "numpy" engine the file is written directly using
+    `encode_byte_offset`, with the "cbflib" engine through a CBF instance.
+    """
+    arr = np.asarray(arr)
+    if arr.ndim < 1 or arr.ndim > 3:
+        raise ValueError("Expecting an array with 1 to 3 dimensions")
+    if engine == "cbflib":
+        h = CBF()
+        h.new_datablock(name)
+        h.new_category("array_data")
+        h.new_column("header_convention")
+        h.set_value(convention)
+        h.set_typeofvalue("dblq")
+        h.new_column("header_contents")
+        h.set_value(header)
+        h.set_typeofvalue("text")
+        h.new_column("data")
+        if arr.dtype.kind == "f":
+            h.set_realarray(arr, padding=padding)
+        elif compressed:
+            h.set_integerarray(arr, padding=padding)
+        else:
+            h.set_integerarray(arr, Compression.CBF_NONE, padding=padding)
+        h.write_file(filename, encoding=Encoding.ENC_NONE|Encoding.ENC_CRTERM
+            |Encoding.ENC_LFTERM, headers=Headers.MIME_HEADERS
+            |Headers.MSG_DIGEST|(Headers.PAD_4K if padding else 0))
+        h.close()
+        return
+    elif engine != "numpy":
+        raise ValueError("Unknown engine: %s" % str(engine))
+    if arr.dtype.kind == "f":
+        conversions = "x-CBF_NONE"
+        eltype = "signed %d-bit real IEEE" % (8*arr.itemsize)
+        data = np.ascontiguousarray(arr, arr.dtype.newbyteorder("<")).tobytes()
+    elif arr.dtype.kind in "iu":
+        eltype = "%s %d-bit integer" % (
+            "signed" if arr.dtype.kind == "i" else "unsigned", 8*arr.itemsize)
+        if compressed:
+            conversions = "x-CBF_BYTE_OFFSET"
+            data = encode_byte_offset(arr)
+        else:
+            conversions = "x-CBF_NONE"
+            data = np.ascontiguousarray(arr,
+                arr.dtype.newbyteorder("<")).tobytes()
+    else:
+        raise TypeError("Expecting an integer or a float array")
+    dimnames = ["Fastest", "Second", "Third"]
+    dims = "\r\n".join("X-Binary-Size-%s-Dimension: %d" % (dimnames[i], d)
+        for i, d in enumerate(arr.shape[::-1]))
+    md5 = _str(base64.b64encode(hashlib.md5(data).digest()))
+    text = _frame_template % {
+        "name" : name,
+        "convention" : convention,
+        "contents" : "\r\n".join(header.splitlines()),
+        "conversions" : conversions,
+        "size" : len(data),
+        "eltype" : eltype,
+        "md5" : md5,
+        "nelem" : arr.size,
+        "dims" : dims,
+        "padding" : padding,
+        }
+    f = open(filename, 'wb')
+    try:
+        f.write(text.encode("latin-1"))
+        f.write(BINARY_MARKER)
+        f.write(data)
+        f.write(b"\0" * padding)
+        f.write(b"\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n\r\n")
+    finally:
+        f.close()
+
+
+def binary_dtype(p, native=False):
+    """Return the Numpy dtype for decoding a binary with parameters `p`.
+
+    The default types are int32, uint32 and float64. If `native` is True,
+    the element size in the file is used. `p` is a dictionary from
+    `CBF.get_arrayparameters` or `binary_sections`.
+    """
+    # CBFlib sets elsigned also for real arrays
+    if p["realarray"]:
+        kind = "f"
+    elif p["elunsigned"]:
+        kind = "u"
+    else:
+        kind = "i"
+    if native:
+        return np.dtype("%s%d" % (kind, p["elsize"]))
+    else:
+        return np.dtype("%s%d" % (kind, 8 if kind == "f" else 4))
+
+
+def decode_binary(buf, p, copy=True, dtype=None, out=None, roi=None,
+        checkpoints=None, verify=False):
+    """Return the binary section with parameters `p` in `buf` as a
+    Numpy array.
+
+    `p` is a dictionary generated by `binary_sections`. Uncompressed and
+    x-CBF_BYTE_OFFSET compressed sections are supported, other
+    compressions raise RuntimeError(Errors.CBF_NOTIMPLEMENTED). The
+    array type is `dtype`, by default the same as from `CBF.get_binary`
+    with the "cbflib" engine.
+
+    If `out` is given, the values are decoded into it and it is returned.
+    Byte offset compressed data is summed directly into C-contiguous
+    integer arrays, other arrays are filled through a temporary array.
+
+    If `copy` is False, uncompressed sections are returned as views to
+    `buf` with the element type of the file. The views are read-only if
+    `buf` is, e.g. a string or an mmap object returned by `map_file`.
+
+    If `roi` is given, only the region `arr[roi]` of the full array `arr`
+    is returned, e.g. roi=(slice(100, 150), slice(200, 250)). Only the
+    rows of the first axis selected by the region are decoded, if the
+    section is uncompressed or the `checkpoints` from `binary_checkpoints`
+    are given. Byte offset compressed data is otherwise decoded from the
+    start of the section up to the last row of the region.
+
+    If `verify` is True, the Content-MD5 of the section is checked with
+    `check_md5` in a background thread while decoding, and a mismatch
+    raises RuntimeError(Errors.CBF_FORMAT), like in CBFlib.
+    """
+    if verify:
+        res = _verify_pool().apply_async(check_md5, (buf, p))
+        arr = decode_binary(buf, p, copy, dtype, out, roi, checkpoints)
+        if res.get() is False:
+            raise RuntimeError(Errors.CBF_FORMAT)
+        return arr
+    order = "<" if p["byteorder"] == "little_endian" else ">"
+    if out is not None:
+        dtype = out.dtype
+    elif dtype is None:
+        dtype = binary_dtype(p)
+    dtype = np.dtype(dtype)
+    if roi is not None:
+        return _decode_roi(buf, p, roi, dtype, out, checkpoints)
+    nelem = int(np.prod(p["shape"]))
+    compression = p["compression"] & Compression.CBF_COMPRESSION_MASK
+    if compression == Compression.CBF_BYTE_OFFSET and not p["realarray"]:
+        data = np.frombuffer(buf, dtype=np.uint8, count=p["size"],
+            offset=p["offset"])
+        if dtype.kind in "iu":
+            arr = _contiguous_out(p["shape"], dtype, out)
+        else:
+            arr = np.empty(p["shape"], dtype=binary_dtype(p, True))
+        t0 = time.time()
+        decode_byte_offset(data, nelem, out=arr, byteorder=order)
+        _record("decode", t0, arr.nbytes)
+    elif compression == Compression.CBF_NONE:
+        if p["realarray"]:
+            eltype = "%sf%d" % (order, p["elsize"])
+        else:
+            eltype = "%s%s%d" % (order, "u" if p["elunsigned"] else "i",
+                p["elsize"])
+        arr = np.frombuffer(buf, dtype=eltype, count=nelem,
+            offset=p["offset"]).reshape(p["shape"])
+        if out is None and not copy:
+            return arr
+        elif out is None:
+            t0 = time.time()
+            arr = arr.astype(dtype)
+            _record("convert", t0, arr.nbytes)
+            return arr
+    else:
+        raise RuntimeError(Errors.CBF_NOTIMPLEMENTED)
+    if out is not None:
+        if arr is not out:
+            t0 = time.time()
+            out[...] = arr.reshape(out.shape)
+            _record("convert", t0, out.nbytes)
+        return out
+    if arr.dtype != dtype:
+        t0 = time.time()
+        arr = arr.astype(dtype)
+        _record("convert", t0, arr.nbytes)
+    return arr
+
+
+def section_md5(buf, p):
+    """Return the base64 encoded MD5 digest of the binary section `p` in
+    `buf`, computed over a view of `buf` without copying.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8, count=p["size"],
+        offset=p["offset"])
+    return _str(base64.b64encode(hashlib.md5(data).digest()))
+
+
+def check_md5(buf, p):
+    """Return True if the Content-MD5 of the binary section `p` in `buf`
+    matches its data, False if not and None if the section has no MD5.
+    """
+    if not p["md5"]:
+        return None
+    return section_md5(buf, p) == p["md5"]
+
+
+_verify_threads = None
+_verify_lock = threading.Lock()
+
+
+def _verify_pool():
+    """Return the thread pool computing MD5 digests in the background."""
+    global _verify_threads
+    _verify_lock.acquire()
+    try:
+        if _verify_threads is None:
+            from multiprocessing.pool import ThreadPool
+            _verify_threads = ThreadPool(multiprocessing.cpu_count())
+        return _verify_threads
+    finally:
+        _verify_lock.release()
+
+
+def _iter_values(buf, p, nelem, chunksize):
+    """Generate the first `nelem` values of the binary section `p` in
+    `buf` as consecutive flat arrays of about `chunksize` elements.
+    """
+    order = "<" if p["byteorder"] == "little_endian" else ">"
+    compression = p["compression"] & Compression.CBF_COMPRESSION_MASK
+    if compression == Compression.CBF_BYTE_OFFSET and not p["realarray"]:
+        data = np.frombuffer(buf, dtype=np.uint8, count=p["size"],
+            offset=p["offset"])
+        return _iter_byte_offset(data, nelem, chunksize, order)
+    elif compression == Compression.CBF_NONE:
+        if p["realarray"]:
+            eltype = "%sf%d" % (order, p["elsize"])
+        else:
+            eltype = "%s%s%d" % (order, "u" if p["elunsigned"] else "i",
+                p["elsize"])
+        flat = np.frombuffer(buf, dtype=eltype, count=nelem,
+            offset=p["offset"])
+        return (flat[i:i+chunksize] for i in range(0, nelem, chunksize))
+    else:
+        raise RuntimeError(Errors.CBF_NOTIMPLEMENTED)
+
+
+def decode_binned(buf, p, bin, binmode="sum", out=None, chunksize=1 << 20):
+    """Return the 2D binary section `p` in `buf` binned to blocks of
+    `bin` = (rows, columns) pixels.
+
+    The blocks are summed if `binmode` is "sum" and averaged if it is
+    "mean". Rows and columns which do not fill a whole block at the end
+    of the array are left out. Bands of rows of about `chunksize`
+    elements are decoded and binned at a time, so that the full array is
+    never created. The result is int64 for sums of integers and float64
+    otherwise, unless `out` is given.
+    """
+    if len(p["shape"]) != 2:
+        raise ValueError("Only 2D arrays can be binned")
+    if binmode not in ("sum", "mean"):
+        raise ValueError("Unknown binmode: %s" % binmode)
+    ny, nx = p["shape"]
+    by, bx = bin
+    nyb, nxb = ny // by, nx // bx
+    acctype = np.float64 if p["realarray"] else np.int64
+    if out is None:
+        dtype = np.float64 if binmode == "mean" else acctype
+        out = np.empty((nyb, nxb), dtype=dtype)
+    elif out.shape != (nyb, nxb):
+        raise ValueError("Output array must have shape %s" % ((nyb, nxb),))
+    band = by*nx
+    bands = np.empty(max(1, chunksize // band)*band, dtype=acctype)
+    state = {"filled" : 0, "row" : 0}
+    def flush():
+        k = state["filled"] // band
+        blocks = bands[:k*band].reshape(k, by, nx)[:,:,:nxb*bx]
+        sums = blocks.reshape(k, by, nxb, bx).sum(axis=3).sum(axis=1)
+        row = state["row"]
+        if binmode == "mean":
+            out[row:row+k] = sums / float(by*bx)
+        else:
+            out[row:row+k] = sums
+        state["row"] += k
+        state["filled"] = 0
+    t0 = time.time()
+    for vals in _iter_values(buf, p, nyb*by*nx, chunksize):
+        pos = 0
+        while pos < len(vals):
+            filled = state["filled"]
+            n = min(len(vals) - pos, len(bands) - filled)
+            bands[filled:filled+n] = vals[pos:pos+n]
+            state["filled"] += n
+            pos += n
+            if state["filled"] == len(bands):
+                flush()
+    if state["filled"]:
+        flush()
+    _record("decode", t0, out.nbytes)
+    return out
+
+
+class SparseFrame:
+    """A frame stored as the flat indices and values of its nonzero
+    elements, in increasing order of the index. The indices are int32
+    if the frame has less than 2**31 elements.
+
+    The dense frame of shape `shape` is returned by `toarray` and the
+    indices as row and column coordinates by `coords`. `tocoo` and
+    `tocsr` return scipy.sparse matrices of 2D frames, if scipy is
+    available.
+    """
+    def __init__(self, shape, indices, values):
+        self.shape = tuple(shape)
+        self.indices = indices
+        self.values = values
+        self.dtype = values.dtype
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+    def coords(self):
+        """Return the index arrays of the nonzero elements, one for
+        each dimension.
+        """
+        return np.unravel_index(self.indices, self.shape)
+
+    def toarray(self, out=None):
+        """Return the frame as a dense array, written to `out` if given."""
+        if out is None:
+            out = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            out[...] = 0
+        if out.flags.c_contiguous:
+            out.reshape(-1)[self.indices] = self.values
+        else:
+            out[np.unravel_index(self.indices, out.shape)] = self.values
+        return out
+
+    def tocoo(self):
+        import scipy.sparse
+        row, col = self.coords()
+        return scipy.sparse.coo_matrix((self.values, (row, col)),
+            shape=self.shape)
+
+    def tocsr(self):
+        return self.tocoo().tocsr()
+
+    def __repr__(self):
+        return "<SparseFrame shape=%s dtype=%s nnz=%d>" % (
+            self.shape, self.dtype, self.nnz)
+
+
+def decode_sparse(buf, p, dtype=None, chunksize=1 << 20, verify=False):
+    """Return the nonzero elements of the binary section `p` in `buf` as
+    a `SparseFrame`, without decoding the whole array at once.
+
+    Byte offset compressed data is decoded and uncompressed data read
+    in chunks of `chunksize` elements, so that the memory used is about
+    that of the nonzero elements. The values have the type `dtype`, by
+    default the same as from `decode_binary`. See `decode_binary` for
+    `verify`.
+    """
+    if verify:
+        res = _verify_pool().apply_async(check_md5, (buf, p))
+        frame = decode_sparse(buf, p, dtype, chunksize)
+        if res.get() is False:
+            raise RuntimeError(Errors.CBF_FORMAT)
+        return frame
+    if dtype is None:
+        dtype = binary_dtype(p)
+    dtype = np.dtype(dtype)
+    nelem = int(np.prod(p["shape"]))
+    chunks = _iter_values(buf, p, nelem, chunksize)
+    itype = np.int32 if nelem < 2**31 else np.int64
+    t0 = time.time()
+    indices, values = [np.zeros(0, itype)], [np.zeros(0, dtype)]
+    start = 0
+    for vals in chunks:
+        nz = np.flatnonzero(vals)
+        indices.append((nz + start).astype(itype))
+        values.append(vals[nz].astype(dtype))
+        start += len(vals)
+    indices = np.concatenate(indices)
+    values = np.concatenate(values)
+    _record("decode", t0, indices.nbytes + values.nbytes)
+    return SparseFrame(p["shape"], indices, values)
+
+
+def binary_checkpoints(buf, p):
+    """Return the checkpoint index of the binary section `p` in `buf`.
+
+    The index of a byte offset compressed section with the rows of the
+    first axis as checkpoints is returned, see `byte_offset_index`, or
+    None if the section does not need one for decoding a region.
+    """
+    compression = p["compression"] & Compression.CBF_COMPRESSION_MASK
+    if compression != Compression.CBF_BYTE_OFFSET or p["realarray"]:
+        return None
+    order = "<" if p["byteorder"] == "little_endian" else ">"
+    data = np.frombuffer(buf, dtype=np.uint8, count=p["size"],
+        offset=p["offset"])
+    shape = p["shape"]
+    return byte_offset_index(data, int(np.prod(shape)),
+        int(np.prod(shape[1:])), order)
+
+
+def _roi_rows(shape, roi):
+    """Return the indices of the rows (along the first axis) of an array
+    of `shape` in the region `roi`, and the first and the last + 1 of
+    them.
+    """
+    if not isinstance(roi, tuple):
+        roi = (roi,)
+    rows = np.arange(shape[0])[roi[0]]
+    if rows.size:
+        return rows, int(rows.min()), int(rows.max()) + 1
+    return rows, 0, 0
+
+
+def _decode_roi(buf, p, roi, dtype, out, checkpoints):
+    """Decode the region `roi` of a binary section, see `decode_binary`.
+    """
+    if not isinstance(roi, tuple):
+        roi = (roi,)
+    order = "<" if p["byteorder"] == "little_endian" else ">"
+    shape = p["shape"]
+    rowlen = int(np.prod(shape[1:]))
+    rows, lo, hi = _roi_rows(shape, roi)
+    nelem = (hi - lo)*rowlen
+    compression = p["compression"] & Compression.CBF_COMPRESSION_MASK
+    t0 = time.time()
+    if compression == Compression.CBF_BYTE_OFFSET and not p["realarray"]:
+        data = np.frombuffer(buf, dtype=np.uint8, count=p["size"],
+            offset=p["offset"])
+        eltype = dtype if dtype.kind in "iu" else binary_dtype(p, True)
+        if checkpoints is not None:
+            start, end = checkpoints[0,lo], checkpoints[0,hi]
+            block = decode_byte_offset(data[start:end], nelem, eltype,
+                byteorder=order, initial=int(checkpoints[1,lo]))
+        else:
+            block = _decode_byte_offset_head(data, hi*rowlen,
+                shape[0]*rowlen, eltype, order)[lo*rowlen:]
+    elif compression == Compression.CBF_NONE:
+        if p["realarray"]:
+            eltype = "%sf%d" % (order, p["elsize"])
+        else:
+            eltype = "%s%s%d" % (order, "u" if p["elunsigned"] else "i",
+                p["elsize"])
+        block = np.frombuffer(buf, dtype=eltype, count=nelem,
+            offset=p["offset"] + lo*rowlen*p["elsize"])
+    else:
+        raise RuntimeError(Errors.CBF_NOTIMPLEMENTED)
+    _record("decode", t0, block.nbytes)
+    arr = block.reshape((hi - lo,) + tuple(shape[1:]))[(rows - lo,) + roi[1:]]
+    if out is not None:
+        out[...] = arr.reshape(out.shape)
+        return out
+    return arr.astype(dtype)
+
+
+def _decode_byte_offset_head(data, nelem, total, dtype, byteorder="<"):
+    """Decode the first `nelem` of the `total` values of byte offset
+    compressed `data`.
+
+    Only a head of the data is decoded. Its length is estimated from
+    the mean number of bytes per element, and grown until it has
+    `nelem` complete elements.
+    """
+    end = min(len(data), int(len(data) * float(nelem) / total * 1.05) + 15)
+    while True:
+        deltas, keep = _byte_offset_deltas(data[:end], dtype, byteorder,
+            partial=True)
+        if end == len(data):
+            complete = len(deltas)
+        else:
+            # Tokens starting in the last 14 bytes can be cut
+            complete = int(np.count_nonzero(keep[:end-14]))
+        if complete >= nelem or end == len(data):
+            break
+        end = min(len(data),
+            int(end * float(nelem) / max(complete, 1) * 1.05) + 15)
+    if len(deltas) < nelem:
+        raise RuntimeError(Errors.CBF_FORMAT)
+    return np.cumsum(deltas[:nelem], dtype=dtype)
+
+
+def _iter_byte_offset(data, nelem, chunksize=1 << 20, byteorder="<"):
+    """Generate the first `nelem` values of byte offset compressed `data`
+    as consecutive int64 arrays of about `chunksize` elements.
+
+    The data is decoded in windows of bytes, so that less than one
+    window is read beyond the last element.
+    """
+    value, done, pos = 0, 0, 0
+    while done < nelem:
+        # Every element takes at least one byte and 15 at most
+        size = max(min(nelem - done, chunksize), 1)
+        window = data[pos:pos+size+14]
+        deltas, keep = _byte_offset_deltas(window, np.int64, byteorder,
+            partial=True)
+        starts = np.flatnonzero(keep)
+        if pos + len(window) >= len(data):
+            n = len(starts)
+        else:
+            n = int(np.searchsorted(starts, size))
+        n = min(n, nelem - done)
+        if n == 0:
+            raise RuntimeError(Errors.CBF_FORMAT)
+        deltas[0] += value
+        vals = np.cumsum(deltas[:n])
+        value = int(vals[-1])
+        done += n
+        pos += int(starts[n]) if n < len(starts) else len(window)
+        yield vals
+
+
+_item_re = br"(?:^|\n)_array_data\.%s[ \t]*(?:\r?\n;(.*?)\r?\n;|[ \t\r\n]+(?:\"([^\"]*)\"|'([^']*)'|([^ \t\r\n]+)))"
+_header_convention_re = re.compile(_item_re % b"header_convention", re.S)
+_header_contents_re = re.compile(_item_re % b"header_contents", re.S)
+
+
+def _item_value(regex, text):
+    """Return the value matched by `regex` in `text` as a string or None.
+    """
+    mob = regex.search(text)
+    if mob is None:
+        return None
+    if mob.group(1) is not None:
+        # Text field, starting after the line with the semicolon
+        val = mob.group(1).replace(b"\r\n", b"\n")
+        if val.startswith(b"\n"):
+            val = val[1:]
+        return _str(val)
+    return _str([g for g in mob.groups()[1:] if g is not None][0])
+
+
+def read_header(filename, blocksize=4096):
+    """Return the header of the first datablock in a CBF file.
+
+    Only the part of the file before the first binary section is read,
+    in increments of `blocksize` bytes, and CBFlib is not used. The
+    returned dictionary has these keys:
+        "name" : name of the datablock
+        "header_convention" : value of _array_data.header_convention
+        "header_contents" : value of _array_data.header_contents
+        "parameters" : parameters of the first binary section as given
+            by `binary_sections` or None if there are no binaries
+    The header values are None if they are not found.
+    """
+    t0 = time.time()
+    f = open(filename, 'rb')
+    try:
+        buf = f.read(blocksize)
+        while True:
+            start = buf.find(BINARY_START)
+            if start >= 0 and buf.find(BINARY_MARKER, start) >= 0:
+                break
+            chunk = f.read(len(buf))
+            if not chunk:
+                break
+            buf += chunk
+    finally:
+        f.close()
+    start = buf.find(BINARY_START)
+    text = buf if start < 0 else buf[:start]
+    names = _datablock_re.findall(text)
+    params = None
+    if start >= 0:
+        params = next(binary_sections(buf), None)
+    _record("header", t0, len(buf))
+    return {
+        "name" : _str(names[0]) if names else None,
+        "header_convention" : _item_value(_header_convention_re, text),
+        "header_contents" : _item_value(_header_contents_re, text),
+        "parameters" : params,
+        }
+
+
+_unit_factors = {
+    "s" : 1.0, "ms" : 1e-3, "us" : 1e-6, "ns" : 1e-9,
+    "m" : 1.0, "mm" : 1e-3, "um" : 1e-6, "A" : 1e-10,
+    "eV" : 1.0, "keV" : 1e3,
+    "deg" : 1.0, "deg." : 1.0,
+    }
+
+_quantity_re = re.compile(r"([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*([A-Za-z.]*)")
+_header_line_re = re.compile(r"^#\s*([A-Za-z][A-Za-z0-9_]*)[\s:=]*(.*?)\s*$")
+_sensor_re = re.compile(r"^#\s*(\w+) sensor, thickness\s+(.*?)\s*$")
+_timestamp_re = re.compile(r"^#\s*(\d{4}[-/]\S+[ T]\d+:\d+:\d+(?:\.\d*)?)\s*$")
+
+
+def _quantity(value):
+    """Return the first number in `value` as a float in SI units
+    (except energies in eV and angles in degrees).
+    """
+    mob = _quantity_re.search(value)
+    if mob is None:
+        return None
+    return float(mob.group(1)) * _unit_factors.get(mob.group(2), 1.0)
+
+
+def _quantities(value):
+    """Return a tuple of all numbers in `value`, see `_quantity`."""
+    return tuple(float(num) * _unit_factors.get(unit, 1.0)
+        for num, unit in _quantity_re.findall(value))
+
+
+def _integer(value):
+    mob = _quantity_re.search(value)
+    if mob is None:
+        return None
+    return int(float(mob.group(1)))
+
+
+_header_fields = {
+    "exposure_time" : _quantity,
+    "exposure_period" : _quantity,
+    "tau" : _quantity,
+    "count_cutoff" : _integer,
+    "threshold_setting" : _quantity,
+    "n_excluded_pixels" : _integer,
+    "pixel_size" : _quantities,
+    "wavelength" : _quantity,
+    "detector_distance" : _quantity,
+    "detector_voffset" : _quantity,
+    "beam_xy" : _quantities,
+    "flux" : _quantity,
+    "filter_transmission" : _quantity,
+    "start_angle" : _quantity,
+    "angle_increment" : _quantity,
+    "detector_2theta" : _quantity,
+    "polarization" : _quantity,
+    "alpha" : _quantity,
+    "kappa" : _quantity,
+    "phi" : _quantity,
+    "phi_increment" : _quantity,
+    "chi" : _quantity,
+    "chi_increment" : _quantity,
+    "omega" : _quantity,
+    "omega_increment" : _quantity,
+    "n_oscillations" : _integer,
+    "energy_range" : _quantities,
+    }
+
+_header_cache = {}
+_header_cache_size = 4096
+
+
+def parse_header_contents(text):
+    """Return the fields of a Pilatus miniCBF header as a dictionary.
+
+    `text` is the value of _array_data.header_contents, with lines like
+    "# Exposure_time 0.500000 s". The keys are the lower case field names,
+    e.g. "exposure_time", "pixel_size", "beam_xy", "wavelength" and
+    "detector_distance". Known numeric fields are converted to floats in
+    SI units (s, m), except energies, which are in eV, and angles, which
+    are in degrees. "pixel_size", "beam_xy" (in pixels) and
+    "energy_range" are tuples. The date line is returned as the string
+    "timestamp", the sensor line as "sensor" and "thickness", and other
+    fields as strings.
+
+    The results are cached by `text`, a new dictionary is returned on
+    every call.
+    """
+    hd = _header_cache.get(text)
+    if hd is not None:
+        return dict(hd)
+    hd = {}
+    for line in text.replace("Pixel size", "Pixel_size").splitlines():
+        mob = _timestamp_re.match(line)
+        if mob is not None:
+            hd["timestamp"] = mob.group(1)
+            continue
+        mob = _sensor_re.match(line)
+        if mob is not None:
+            hd["sensor"] = mob.group(1)
+            hd["thickness"] = _quantity(mob.group(2))
+            continue
+        mob = _header_line_re.match(line)
+        if mob is None:
+            continue
+        key = mob.group(1).lower()
+        conv = _header_fields.get(key)
+        if conv is None:
+            hd[key] = mob.group(2)
+        else:
+            hd[key] = conv(mob.group(2))
+    if len(_header_cache) >= _header_cache_size:
+        _header_cache.clear()
+    _header_cache[text] = hd
+    return dict(hd)
+
+
+def map_file(filename):
+    """Return the contents of file `filename` as a read-only mmap object.
+    """
+    f = open(filename, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def read_binary(filename, index=0, copy=True, native=False, out=None,
+        roi=None, sidecar=False, verify=False, sparse=False, bin=None,
+        binmode="sum"):
+    """Return binary section number `index` in a CBF file as a Numpy array.
+
+    The file is memory-mapped, parsed and decoded without CBFlib, see
+    `decode_binary`. With `copy` False, uncompressed arrays are read-only
+    views to the mapped file and only the pages which are accessed are
+    read from disk. See `CBF.get_binary` for `native` and `out`.
+
+    If `roi` is given, only that region of the array is returned, see
+    `decode_binary`. If `sidecar` is True, the checkpoints of a byte
+    offset compressed section are written on the first read to a file
+    with the name given by `checkpoint_file` and loaded from it on
+    the next reads, so that only the rows in the region are decoded.
+    See `decode_binary` for `verify`. If `sparse` is True, a
+    `SparseFrame` from `decode_sparse` is returned. If `bin` is given,
+    the array is binned while decoding, see `decode_binned`.
+    """
+    t0 = time.time()
+    buf = map_file(filename)
+    _record("fopen", t0)
+    t0 = time.time()
+    for i, p in enumerate(binary_sections(buf)):
+        if i == index:
+            _record("parse", t0, p["offset"])
+            if sparse:
+                return decode_sparse(buf, p, binary_dtype(p, native),
+                    verify=verify)
+            if bin is not None:
+                if verify:
+                    res = _verify_pool().apply_async(check_md5, (buf, p))
+                arr = decode_binned(buf, p, bin, binmode, out)
+                if verify and res.get() is False:
+                    raise RuntimeError(Errors.CBF_FORMAT)
+                return arr
+            checkpoints = None
+            if roi is not None and sidecar:
+                checkpoints = _sidecar_checkpoints(filename, index, buf, p)
+            return decode_binary(buf, p, copy=copy,
+                dtype=binary_dtype(p, native), out=out, roi=roi,
+                checkpoints=checkpoints, verify=verify)
+    raise IndexError(index)
+
+
+def checkpoint_file(filename, index=0):
+    """Return the name of the checkpoint sidecar file of binary section
+    `index` in file `filename`.
+    """
+    return "%s.%d.idx.npz" % (filename, index)
+
+
+def _sidecar_checkpoints(filename, index, buf, p):
+    """Return the checkpoints of section `p`, loading them from the
+    sidecar file if it is up to date, otherwise computing and saving
+    them. Failing to write the sidecar is not an error.
+    """
+    compression = p["compression"] & Compression.CBF_COMPRESSION_MASK
+    if compression != Compression.CBF_BYTE_OFFSET or p["realarray"]:
+        return None
+    fname = checkpoint_file(filename, index)
+    try:
+        if os.path.getmtime(fname) >= os.path.getmtime(filename):
+            f = np.load(fname)
+            try:
+                if (int(f["offset"]) == p["offset"]
+                        and int(f["size"]) == p["size"]):
+                    return f["index"]
+            finally:
+                f.close()
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    ind = binary_checkpoints(buf, p)
+    try:
+        np.savez(fname, index=ind, offset=p["offset"], size=p["size"])
+    except (IOError, OSError):
+        pass
+    return ind
+
+
+####
+#
+#   Reading many files
+
+class FrameCache:
+    """Least recently used cache of decoded frames, limited by size.
+
+    Frames are kept by `key`, which includes the modification time and
+    size of the file, so that rewritten files are read again. The least
+    recently used frames are evicted when the total size of the cached
+    arrays would exceed `maxbytes`. The cached arrays are read-only.
+
+    The numbers of cache hits, misses and evictions are in the attributes
+    `hits`, `misses` and `evictions`, see also `asdict`. A cache can be
+    shared by threads and given to `CBF.get_binary`, `read_frame` and
+    `read_stack`.
+    """
+    def __init__(self, maxbytes=1 << 30):
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all frames and zero the statistics."""
+        self._frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, filename, datablock=None, category="array_data",
+            column="data", row=0, *extra):
+        """Return the cache key of a value in file `filename`.
+
+        The key is a tuple (path, mtime, size, datablock, category, column,
+        row) followed by the `extra` arguments, which must be hashable.
+        A `datablock` of None refers to the first datablock, and is
+        replaced by its name, so that the same value has the same key
+        whether it is read by name or as the first datablock.
+        """
+        st = os.stat(filename)
+        if datablock is None:
+            datablock = _first_datablock(filename)
+        return (os.path.abspath(filename), st.st_mtime, st.st_size,
+            datablock, category, column, row) + extra
+
+    def get(self, key):
+        """Return the frame with `key` or None if it is not cached."""
+        self._lock.acquire()
+        try:
+            arr = self._frames.pop(key, None)
+            if arr is None:
+                self.misses += 1
+                return None
+            self._frames[key] = arr
+            self.hits += 1
+            return arr
+        finally:
+            self._lock.release()
+
+    def put(self, key, arr):
+        """Cache the array `arr` with `key`, evicting old frames.
+
+        Arrays larger than `maxbytes` are not cached.
+        """
+        if arr.nbytes > self.maxbytes:
+            return
+        arr.setflags(write=False)
+        self._lock.acquire()
+        try:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            while self._frames and self.nbytes + arr.nbytes > self.maxbytes:
+                k, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+            self._frames[key] = arr
+            self.nbytes += arr.nbytes
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def asdict(self):
+        """Return the statistics as a dictionary with keys "hits",
+        "misses", "evictions", "frames", "nbytes" and "maxbytes".
+        """
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+            "frames" : len(self._frames),
+            "nbytes" : self.nbytes,
+            "maxbytes" : self.maxbytes,
+            }
+
+
+def _first_datablock(filename, blocksize=4096):
+    """Return the name of the first datablock in a CBF file or None."""
+    f = open(filename, "rb")
+    try:
+        buf = b""
+        while True:
+            chunk = f.read(blocksize)
+            buf += chunk
+            mob = _datablock_re.search(buf)
+            # The name is complete when it is followed by more text
+            if mob is not None and (mob.end() < len(buf) or not chunk):
+                return _str(mob.group(1))
+            if not chunk:
+                return None
+    finally:
+        f.close()
+
+
+def _cached(cache, key, read, out):
+    """Return the frame with `key` from `cache` or call `read` to read and
+    cache it. The frame is copied to `out` if given.
+    """
+    arr = cache.get(key)
+    if arr is None:
+        arr = read()
+        cache.put(key, arr)
+    if out is not None:
+        if arr is not out:
+            out[...] = arr.reshape(out.shape)
+        return out
+    return arr
+
+
+def read_frame(filename, engine=None, native=False, out=None, roi=None,
+        cache=None, verify=False, bin=None, binmode="sum", sidecar=False):
+    """Return the array_data.data value in file `filename` as a Numpy array.
+
+    The `engine` is "cbflib", "numpy" or "mmap", by default "cbflib" if
+    CBFlib is available. If a `FrameCache` is given as `cache`, frames
+    are taken from it when possible, and only frames read with `verify`
+    True are returned for `verify` True.
+
+    If `roi` is given, the region is read with `read_binary`, decoding
+    only up to its last row, or only its rows with the checkpoint
+    sidecar file if `sidecar` is True. With the "cbflib" engine and
+    without `sidecar`, regions extending below the middle of the frame
+    are cut from the whole frame decoded by CBFlib, which is faster.
+    See `CBF.get_binary` for the other arguments.
+    """
+    if cache is not None:
+        key = cache.key(filename, None, "array_data", "data", 0, native,
+            repr(roi), bin, binmode, verify)
+        return _cached(cache, key,
+            lambda: read_frame(filename, engine, native, roi=roi,
+                verify=verify, bin=bin, binmode=binmode, sidecar=sidecar),
+            out)
+    if engine is None:
+        engine = "cbflib" if lib is not None else "numpy"
+    crop = None
+    if engine == "cbflib" and roi is not None and bin is None \
+            and not sidecar:
+        p = read_header(filename)["parameters"]
+        if p is not None and 2*_roi_rows(p["shape"], roi)[2] > p["shape"][0]:
+            crop, roi = roi, None
+    if engine == "cbflib" and roi is None:
+        with CBF(filename) as h:
+            h.find_category("array_data")
+            h.find_column("data")
+            h.select_row(0)
+            if crop is not None:
+                arr = h.get_binary(native=native, verify=verify)[crop]
+                if out is not None:
+                    out[...] = arr.reshape(out.shape)
+                    return out
+                return arr.copy()
+            return h.get_binary(native=native, out=out, verify=verify,
+                bin=bin, binmode=binmode)
+    else:
+        return read_binary(filename, copy=(engine != "mmap"), native=native,
+            out=out, roi=roi, sidecar=sidecar, verify=verify, bin=bin,
+            binmode=binmode)
+
+
+def read_stack(filenames, workers=None, engine=None, native=False, out=None,
+        roi=None, cache=None, verify=False, bin=None, binmode="sum",
+        sidecar=False):
+    """Return the frames in a list of files as a single Numpy array.
+
+    The frames are read with `read_frame` in a pool of `workers` threads
+    (by default the number of CPUs) directly into the array `out` of
+    shape (len(filenames), ny, nx), which is allocated if not given.
+    If `roi` is given, only that region of each frame is read, using
+    the checkpoint sidecar files if `sidecar` is True, see `read_frame`.
+    Frames are taken from and added to the `FrameCache` `cache`, if given.
+    If `verify` is True, the Content-MD5 of each frame is checked.
+    If `bin` is given, the frames are binned while decoding, so that
+    only the binned frames are stored, see `decode_binned`.
+    Each thread uses its own CBF instance, and CBFlib calls and most of
+    the Numpy decoding run without holding the GIL.
+    """
+    n = len(filenames)
+    if out is None:
+        first = read_frame(filenames[0], engine, native, roi=roi,
+            cache=cache, verify=verify, bin=bin, binmode=binmode,
+            sidecar=sidecar)
+        out = np.empty((n,) + first.shape, dtype=first.dtype)
+        out[0] = first
+        start = 1
+    else:
+        start = 0
+    def read(i):
+        read_frame(filenames[i], engine, native, out=out[i], roi=roi,
+            cache=cache, verify=verify, bin=bin, binmode=binmode,
+            sidecar=sidecar)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or n - start <= 1:
+        for i in range(start, n):
+            read(i)
+        return out
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, n - start))
+    try:
+        pool.map(read, range(start, n))
+    finally:
+        pool.close()
+        pool.join()
+    return out
+
+
+def verify(paths, workers=None):
+    """Check the Content-MD5 of every binary section in a list of files.
+
+    Returns a list with an item for each file, True if the digests of
+    all sections match, None if there are no digests and False if a
+    digest does not match or the file can not be read or parsed. The
+    files are memory-mapped and hashed without copying in a pool of
+    `workers` threads (by default the number of CPUs), which run in
+    parallel, since hashlib releases the GIL.
+    """
+    def check(path):
+        try:
+            buf = map_file(path)
+            res = [check_md5(buf, p) for p in binary_sections(buf)]
+        except (IOError, OSError, RuntimeError, ValueError):
+            return False
+        if False in res:
+            return False
+        return True if True in res else None
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(paths) <= 1:
+        return [check(p) for p in paths]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(paths)))
+    try:
+        return pool.map(check, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class SparseStack:
+    """A series of frames of the same shape stored sparsely.
+
+    Frames are added with `append` as `SparseFrame` objects or dense
+    arrays, and only the indices and values of their nonzero elements
+    are kept. `frame_counts` gives the number of nonzero elements in
+    each frame, `sum` the dense sum image and `tocsr` the stack as a
+    scipy.sparse matrix with a row per frame.
+    """
+    def __init__(self, shape=None):
+        self.shape = None if shape is None else tuple(shape)
+        self._indices = []
+        self._values = []
+
+    def append(self, frame):
+        """Add a `SparseFrame` or a dense array to the stack."""
+        if not isinstance(frame, SparseFrame):
+            frame = np.asarray(frame)
+            flat = frame.reshape(-1)
+            nz = np.flatnonzero(flat)
+            frame = SparseFrame(frame.shape, nz.astype(
+                np.int32 if flat.size < 2**31 else np.int64), flat[nz])
+        if self.shape is None:
+            self.shape = frame.shape
+        elif frame.shape != self.shape:
+            raise ValueError("Frame shape %s does not match %s"
+                % (frame.shape, self.shape))
+        self._indices.append(frame.indices)
+        self._values.append(frame.values)
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, i):
+        return SparseFrame(self.shape, self._indices[i], self._values[i])
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes + b.nbytes
+            for a, b in zip(self._indices, self._values))
+
+    def frame_counts(self):
+        """Return the number of nonzero elements in each frame."""
+        return np.array([len(a) for a in self._indices], dtype=np.intp)
+
+    def sum(self):
+        """Return the sum of the frames as a dense float64 array."""
+        npix = int(np.prod(self.shape))
+        total = np.zeros(npix)
+        for ind, vals in zip(self._indices, self._values):
+            total += np.bincount(ind, vals, minlength=npix)
+        return total.reshape(self.shape)
+
+    def toarray(self):
+        """Return the stack as a dense array of shape (nframes,) + shape."""
+        dtype = self._values[0].dtype if self._values else np.int32
+        out = np.zeros((len(self),) + self.shape, dtype=dtype)
+        for i in range(len(self)):
+            self[i].toarray(out=out[i])
+        return out
+
+    def tocsr(self):
+        """Return the stack as a scipy.sparse.csr_matrix with the
+        flattened frames as rows.
+        """
+        import scipy.sparse
+        indptr = np.concatenate([[0], np.cumsum(self.frame_counts())])
+        return scipy.sparse.csr_matrix((np.concatenate(self._values),
+            np.concatenate(self._indices), indptr),
+            shape=(len(self), int(np.prod(self.shape))))
+
+
+def read_sparse_stack(filenames, workers=None, native=False):
+    """Return the frames in a list of files as a `SparseStack`.
+
+    The frames are decoded with `read_binary` (sparse=True) in a pool of
+    `workers` threads, by default the number of CPUs, without creating
+    dense frames.
+    """
+    def read(fname):
+        return read_binary(fname, native=native, sparse=True)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    stack = SparseStack()
+    if workers <= 1 or len(filenames) <= 1:
+        for fname in filenames:
+            stack.append(read(fname))
+        return stack
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(filenames)))
+    try:
+        for frame in pool.imap(read, filenames):
+            stack.append(frame)
+    finally:
+        pool.close()
+        pool.join()
+    return stack
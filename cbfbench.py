@@ -0,0 +1,256 @@
+# Author: Teemu Ikonen <teemu.ikonen@psi.ch>
+# Copyright: 2010 Paul Scherrer Institute
+# License:
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation; either version 2 of
+#   (the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+#   02111-1307  USA
+
+import cbf, multiprocessing, os, resource, shutil, sys, tempfile, time
+import numpy as np
+from optparse import OptionParser
+
+description="Benchmark reading CBF files"
+
+usage="""%prog [<file.cbf>]
+       %prog --synthetic [-d pilatus1m,...] [-n nframes]"""
+
+# (slow, fast) dimensions in pixels
+detector_shapes = {
+    "pilatus300k" : (619, 487),
+    "pilatus1m" : (1043, 981),
+    "pilatus2m" : (1679, 1475),
+    "pilatus6m" : (2527, 2463),
+    "eiger16m" : (4371, 4150),
+}
+
+synthetic_header = """# Detector: Synthetic %(detector)s
+# Pixel_size 172e-6 m x 172e-6 m
+# Exposure_time 0.1000000 s
+# Exposure_period 0.1000000 s
+# Wavelength 1.0000 A
+# Detector_distance 0.25000 m
+# Beam_xy (%(beamx).2f, %(beamy).2f) pixels
+# Frame %(frame)d"""
+
+
+def best_time(func, repeat):
+    """Return the smallest wall clock time of `repeat` calls to `func`."""
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def bench_engines(fname, repeat=5):
+    """Return a list of (name, seconds) tuples for reading the first
+    binary array in file `fname` with different engines.
+    """
+    results = []
+    results.append(("read_binary",
+        best_time(lambda: cbf.read_binary(fname), repeat)))
+    if cbf.lib is None:
+        return results
+    for engine in ["cbflib", "numpy"]:
+        def read():
+            h = cbf.CBF(fname, engine=engine)
+            h.find_category("array_data")
+            h.find_column("data")
+            h.get_binary()
+        results.append(("CBF/" + engine, best_time(read, repeat)))
+    return results
+
+
+def synthetic_frame(shape, seed=0, background=0.5, rings=4):
+    """Return a frame with Poisson distributed counts as an int32 array.
+
+    The expected counts are a low `background` with a diffuse scattering
+    halo around the center, a number of powder `rings` and some Bragg
+    peaks, so that most pixels are 0 or 1 like in real exposures.
+    """
+    rs = np.random.RandomState(seed)
+    ny, nx = shape
+    y, x = np.ogrid[0:ny, 0:nx]
+    r = np.sqrt((x - 0.45*nx)**2 + (y - 0.52*ny)**2)
+    lam = background + 200.0*np.exp(-r / (0.02*nx))
+    for i in range(1, rings + 1):
+        lam = lam + 5.0*np.exp(-((r - i*0.1*nx) / 2.0)**2)
+    counts = rs.poisson(lam).astype(np.int32)
+    npeaks = ny*nx // 5000
+    counts[rs.randint(0, ny, npeaks), rs.randint(0, nx, npeaks)] += \
+        rs.poisson(2000.0, npeaks).astype(np.int32)
+    return counts
+
+
+def write_synthetic(dirname, detector, nframes, compressed=True):
+    """Write `nframes` synthetic frames of a detector to files in
+    `dirname` and return the list of file names.
+    """
+    shape = detector_shapes[detector]
+    fnames = []
+    frame = synthetic_frame(shape)
+    for i in range(nframes):
+        header = synthetic_header % {"detector" : detector, "frame" : i,
+            "beamx" : 0.45*shape[1], "beamy" : 0.52*shape[0]}
+        fname = os.path.join(dirname, "%s_%05d.cbf" % (detector, i))
+        # Shift the frame a bit for differing data with the same statistics
+        cbf.write_frame(fname, np.roll(frame, i, axis=1), header,
+            compressed=compressed)
+        fnames.append(fname)
+    return fnames
+
+
+def _read_file(fname):
+    with cbf.CBF(fname):
+        pass
+
+
+def _get_binary(engine):
+    def read(fname):
+        with cbf.CBF(fname, engine=engine) as h:
+            h.find_category("array_data")
+            h.find_column("data")
+            h.get_binary()
+    return read
+
+
+def _datablocks(fname):
+    with cbf.CBF(fname) as h:
+        h.datablocks()
+
+
+def _read_binary(fname):
+    cbf.read_binary(fname)
+
+
+def _read_header(fname):
+    cbf.read_header(fname)
+
+
+def operations():
+    """Return a list of (name, function) tuples of benchmarked operations.
+
+    The functions take a file name as an argument.
+    """
+    ops = [("read_header", _read_header), ("read_binary", _read_binary)]
+    if cbf.lib is not None:
+        ops += [
+            ("read_file", _read_file),
+            ("get_binary/cbflib", _get_binary("cbflib")),
+            ("get_binary/numpy", _get_binary("numpy")),
+            ("datablocks", _datablocks),
+            ]
+    return ops
+
+
+def _run(func, fnames, conn):
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    for fname in fnames:
+        func(fname)
+    t = time.time() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send((t, peak - base))
+    conn.close()
+
+
+def measure(func, fnames):
+    """Return the wall clock time and the peak memory increase in bytes
+    of calling `func` for all files in `fnames` in a child process.
+    """
+    parent, child = multiprocessing.Pipe(False)
+    p = multiprocessing.Process(target=_run, args=(func, fnames, child))
+    p.start()
+    t, peak = parent.recv()
+    p.join()
+    # ru_maxrss is in kilobytes on Linux
+    return t, 1024*peak
+
+
+def bench_synthetic(detectors, nframes, dirname=None):
+    """Benchmark `operations` on synthetic frames of `detectors`.
+
+    Returns a list of dictionaries with keys "detector", "encoding",
+    "operation", "frames/s", "MB/s" and "peak MB".
+    """
+    results = []
+    tmpdir = tempfile.mkdtemp(dir=dirname)
+    try:
+        for detector in detectors:
+            for compressed in [True, False]:
+                fnames = write_synthetic(tmpdir, detector, nframes,
+                    compressed)
+                nbytes = sum(os.path.getsize(f) for f in fnames)
+                for name, func in operations():
+                    t, peak = measure(func, fnames)
+                    results.append({
+                        "detector" : detector,
+                        "encoding" : "byte_offset" if compressed else "none",
+                        "operation" : name,
+                        "frames/s" : nframes / t,
+                        "MB/s" : nbytes / t / 1e6,
+                        "peak MB" : peak / 1e6,
+                        })
+                for f in fnames:
+                    os.remove(f)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def main():
+    oprs = OptionParser(usage=usage, description=description)
+    oprs.add_option("-r", "--repeat",
+        action="store", type="int", dest="repeat", default=5)
+    oprs.add_option("-s", "--synthetic",
+        action="store_true", dest="synthetic", default=False,
+        help="Benchmark with synthetic frames.")
+    oprs.add_option("-d", "--detectors",
+        action="store", type="string", dest="detectors",
+        default="pilatus300k,pilatus1m,pilatus6m,eiger16m",
+        help="Comma separated list of detectors from: "
+            + ", ".join(sorted(detector_shapes.keys())))
+    oprs.add_option("-n", "--nframes",
+        action="store", type="int", dest="nframes", default=10,
+        help="Number of synthetic frames per detector.")
+    oprs.add_option("-t", "--tmpdir",
+        action="store", type="string", dest="tmpdir", default=None,
+        help="Directory for the synthetic files.")
+    (opts, args) = oprs.parse_args()
+    if cbf.lib is None:
+        sys.stderr.write("CBFlib not found, benchmarking numpy engine only\n")
+    if opts.synthetic:
+        detectors = opts.detectors.split(",")
+        for d in detectors:
+            if d not in detector_shapes:
+                oprs.error("Unknown detector: %s" % d)
+        print("%-12s %-12s %-18s %10s %10s %10s" % ("detector", "encoding",
+            "operation", "frames/s", "MB/s", "peak MB"))
+        for r in bench_synthetic(detectors, opts.nframes, opts.tmpdir):
+            print("%(detector)-12s %(encoding)-12s %(operation)-18s "
+                "%(frames/s)10.1f %(MB/s)10.1f %(peak MB)10.1f" % r)
+        return
+    if len(args) > 0:
+        fname = args[0]
+    else:
+        fname = "testdata/agbeh_long.cbf"
+    for name, t in bench_engines(fname, opts.repeat):
+        print("%-16s %8.2f ms" % (name, 1000.0*t))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+# Author: Teemu Ikonen <teemu.ikonen@psi.ch>
+# Copyright: 2010 Paul Scherrer Institute
+# License:
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation; either version 2 of
+#   (the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+#   02111-1307  USA
+
+import cbf, glob, json, os, sys
+import numpy as np
+from optparse import OptionParser
+
+description="Convert a series of CBF files to a HDF5 or .npy stack"
+
+usage="%prog [-o output.h5|output.npy] <directory | file.cbf ...>"
+
+
+def _columns(rows):
+    """Return the list of header dictionaries `rows` as a dictionary of
+    Numpy arrays with one element per row.
+
+    Numbers are converted to floats and sequences of numbers to rows of
+    a 2D array, with missing values as NaN. Other values are strings.
+    """
+    keys = set()
+    for r in rows:
+        keys.update(r.keys())
+    cols = {}
+    for k in sorted(keys):
+        vals = [r.get(k) for r in rows]
+        shapes = set(np.shape(v) for v in vals if v is not None)
+        arr = None
+        if len(shapes) == 1:
+            missing = np.nan * np.ones(shapes.pop())
+            try:
+                arr = np.array([missing if v is None else v for v in vals],
+                    dtype=np.float64)
+            except (TypeError, ValueError):
+                pass
+        if arr is None:
+            arr = np.array([(u"%s" % (v,)).encode("utf-8")
+                if v is not None else b"" for v in vals])
+        cols[k] = arr
+    return cols
+
+
+def _header(filename):
+    """Return the parsed header_contents of a file as a dictionary."""
+    text = cbf.read_header(filename)["header_contents"]
+    return cbf.parse_header_contents(text) if text else {}
+
+
+class _NpyOutput:
+    """A .npy memmap stack with metadata in a .npz file."""
+    def __init__(self, filename, shape, dtype, resume):
+        self.filename = filename
+        mode = "w+"
+        if resume and os.path.exists(filename):
+            arr = np.load(filename, mmap_mode="r")
+            if arr.shape == shape and arr.dtype == dtype:
+                mode = "r+"
+            del arr
+        self.resumed = (mode == "r+")
+        self.data = np.lib.format.open_memmap(filename, mode=mode,
+            dtype=dtype, shape=shape)
+
+    def write(self, start, frames):
+        self.data[start:start+len(frames)] = frames
+        self.data.flush()
+
+    def close(self, meta):
+        np.savez(os.path.splitext(self.filename)[0] + ".meta.npz", **meta)
+        del self.data
+
+
+class _HDF5Output:
+    """A chunked, compressed HDF5 dataset with metadata columns in
+    a group next to it.
+    """
+    def __init__(self, filename, shape, dtype, resume, dataset="data",
+            compression="gzip"):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("h5py is required for writing HDF5 files")
+        self.dataset = dataset
+        self.resumed = False
+        if resume and os.path.exists(filename):
+            self.f = h5py.File(filename, "a")
+            d = self.f.get(dataset)
+            if d is not None and d.shape == shape and d.dtype == dtype:
+                self.data = d
+                self.resumed = True
+                return
+            self.f.close()
+        self.f = h5py.File(filename, "w")
+        self.data = self.f.create_dataset(dataset, shape=shape, dtype=dtype,
+            chunks=(1,) + shape[1:], compression=compression, shuffle=True)
+
+    def write(self, start, frames):
+        self.data[start:start+len(frames)] = frames
+        self.f.flush()
+
+    def close(self, meta):
+        name = self.dataset + "_metadata"
+        if name in self.f:
+            del self.f[name]
+        g = self.f.create_group(name)
+        for k, v in meta.items():
+            g.create_dataset(k, data=v)
+        self.f.close()
+
+
+def progress_file(output):
+    """Return the name of the file recording the progress of conversion
+    to `output`.
+    """
+    return output + ".progress"
+
+
+def _read_progress(fname, filenames):
+    """Return the headers of the frames already converted, as recorded in
+    the progress file `fname`, if they match the start of `filenames`.
+    """
+    rows = []
+    try:
+        f = open(fname, "r")
+    except IOError:
+        return rows
+    try:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # Interrupted while writing the last line
+                break
+            n = len(rows)
+            if (n >= len(filenames)
+                    or rec["filename"] != os.path.basename(filenames[n])):
+                return []
+            rows.append(rec["header"])
+    finally:
+        f.close()
+    return rows
+
+
+def convert(filenames, output, batch=64, workers=None, engine=None,
+        native=False, resume=True, **kwargs):
+    """Convert the frames in a list of CBF files to a single stack.
+
+    The output is a HDF5 file written with h5py if the name of `output`
+    ends with .h5 or .hdf5, otherwise a .npy file. The HDF5 dataset
+    "data" (or the `dataset` keyword argument) is compressed with
+    `compression` (default "gzip") in chunks of one frame. The parsed
+    header_contents of each frame are written as columns of arrays to
+    the group "data_metadata" in a HDF5 file, or to a file with the
+    extension .meta.npz next to a .npy file. The shape and type of the
+    stack are taken from the header of the first file, see
+    cbf.binary_dtype for `native`.
+
+    The frames are read with cbf.read_stack in a pool of `workers`
+    threads, `batch` frames at a time, and each batch is written before
+    the next is read. The converted frames are recorded in a progress
+    file, see `progress_file`, so that an interrupted conversion
+    continues from the first unwritten batch, if `resume` is True.
+    The progress file is removed after the conversion is complete.
+
+    Returns the number of frames converted in this call.
+    """
+    if not filenames:
+        raise ValueError("No files to convert")
+    p = cbf.read_header(filenames[0])["parameters"]
+    dtype = cbf.binary_dtype(p, native)
+    shape = (len(filenames),) + tuple(p["shape"])
+    if output.endswith(".h5") or output.endswith(".hdf5"):
+        out = _HDF5Output(output, shape, dtype, resume, **kwargs)
+    else:
+        out = _NpyOutput(output, shape, dtype, resume)
+    pname = progress_file(output)
+    rows = []
+    if out.resumed:
+        rows = _read_progress(pname, filenames)
+    # Drop a partially written last line
+    pf = open(pname, "w")
+    for fname, hd in zip(filenames, rows):
+        pf.write(json.dumps({"filename" : os.path.basename(fname),
+            "header" : hd}) + "\n")
+    pf.flush()
+    start = len(rows)
+    buf = np.empty((min(batch, len(filenames)),) + shape[1:], dtype=dtype)
+    try:
+        for i in range(start, len(filenames), batch):
+            names = filenames[i:i+batch]
+            frames = cbf.read_stack(names, workers, engine, native,
+                out=buf[:len(names)])
+            out.write(i, frames)
+            for fname in names:
+                hd = _header(fname)
+                rows.append(hd)
+                pf.write(json.dumps({"filename" : os.path.basename(fname),
+                    "header" : hd}) + "\n")
+            pf.flush()
+            os.fsync(pf.fileno())
+    finally:
+        pf.close()
+    out.close(_columns(rows))
+    os.remove(pname)
+    return len(filenames) - start
+
+
+def main():
+    oprs = OptionParser(usage=usage, description=description)
+    oprs.add_option("-o", "--output",
+        action="store", type="string", dest="outfile", default="stack.npy",
+        help="Output .h5 or .npy file (default stack.npy).")
+    oprs.add_option("-b", "--batch",
+        action="store", type="int", dest="batch", default=64,
+        help="Number of frames read and written at a time (default 64).")
+    oprs.add_option("-j", "--workers",
+        action="store", type="int", dest="workers", default=None,
+        help="Number of reading threads (default: number of CPUs).")
+    oprs.add_option("-e", "--engine",
+        action="store", type="string", dest="engine", default=None,
+        help="Decoding engine: cbflib, numpy or mmap.")
+    oprs.add_option("-n", "--native",
+        action="store_true", dest="native", default=False,
+        help="Keep the element size of the files.")
+    oprs.add_option("-r", "--restart",
+        action="store_false", dest="resume", default=True,
+        help="Do not resume an interrupted conversion.")
+    (opts, args) = oprs.parse_args()
+    if len(args) < 1:
+        oprs.error("Input directory or file arguments required")
+
+    if len(args) == 1 and os.path.isdir(args[0]):
+        filenames = sorted(glob.glob(os.path.join(args[0], "*.cbf")))
+    else:
+        filenames = args
+    n = convert(filenames, opts.outfile, opts.batch, opts.workers,
+        opts.engine, opts.native, opts.resume)
+    sys.stdout.write("Converted %d of %d frames to %s\n"
+        % (n, len(filenames), opts.outfile))
+
+
+if __name__ == "__main__":
+    main()
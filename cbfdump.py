@@ -16,15 +16,14 @@
 #   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
 #   02111-1307  USA
 
-import cbf, re, sys
+import cbf, json, re, sys
 import numpy as np
-import matplotlib.pylab as plt
 from optparse import OptionParser
-from xformats.detformats import write_pnglog
 
 description="Show information about a CBF file"
 
-usage="%prog <file.cbf>"
+usage="""%prog <file.cbf>
+       %prog --stats [-f csv|json] <file.cbf> [<file.cbf> ...]"""
 
 
 def read_mask(fname):
@@ -46,22 +45,114 @@ def parse_center(center_str):
         return (float(mob.group(1)), float(mob.group(2)))
 
 
+def bin_mask(mask, b):
+    """Return a mask binned to blocks of `b` x `b` pixels, True in blocks
+    where all the pixels are True, matching cbf.decode_binned.
+    """
+    ny, nx = mask.shape[0] // b, mask.shape[1] // b
+    blocks = mask[:ny*b,:nx*b].reshape(ny, b, nx, b)
+    return blocks.all(axis=3).all(axis=1)
+
+
 def mark_cross(center, **kwargs):
     """Mark a cross. Correct for matplotlib imshow funny coordinate system.
     """
+    import matplotlib.pylab as plt
     N = 20
     plt.hold(1)
     plt.axhline(y=center[1]-0.5, **kwargs)
     plt.axvline(x=center[0]-0.5, **kwargs)
 
 
-def write_to_temp(fin):
-    import tempfile
-    tf = tempfile.NamedTemporaryFile(suffix=".cbfdump.cbf", delete=False)
-    tf.file.write(fin.read())
-    fin.close()
-    tf.file.close()
-    return tf.name
+def read_data(filename, engine=None):
+    """Return the array_data.data array of a CBF file, which can be
+    compressed with bzip2 or gzip.
+    """
+    if filename.endswith(".bz2") or filename.endswith(".gz"):
+        fin = open_compressed(filename)
+        buf = fin.read()
+        fin.close()
+        return cbf.decode_binary(buf, next(cbf.binary_sections(buf)))
+    return cbf.read_frame(filename, engine)
+
+
+def open_compressed(filename):
+    """Return a file object reading a .bz2 or .gz file."""
+    if filename.endswith(".bz2"):
+        import bz2
+        return bz2.BZ2File(filename, mode='r')
+    else:
+        import gzip
+        return gzip.GzipFile(filename, mode='r')
+
+
+stats_fields = ["file", "shape", "dtype", "min", "max", "sum", "mean",
+    "masked_sum", "masked_mean"]
+
+
+def frame_stats(filename, mask=None, engine=None):
+    """Return a dictionary with the shape, dtype, minimum, maximum, sum
+    and mean of the data in a CBF file, and the sum and mean of the
+    pixels where `mask` is True, see `stats_fields`.
+    """
+    d = read_data(filename, engine)
+    total = d.sum(dtype=np.float64 if d.dtype.kind == "f" else np.int64)
+    st = {
+        "file" : filename,
+        "shape" : "x".join(str(n) for n in d.shape),
+        "dtype" : str(d.dtype),
+        "min" : d.min().item(),
+        "max" : d.max().item(),
+        "sum" : total.item(),
+        "mean" : float(total) / d.size,
+        "masked_sum" : None,
+        "masked_mean" : None,
+        }
+    if mask is not None:
+        m = d[mask]
+        msum = m.sum(dtype=total.dtype)
+        st["masked_sum"] = msum.item()
+        st["masked_mean"] = float(msum) / m.size if m.size else None
+    return st
+
+
+def iter_stats(filenames, mask=None, workers=None, engine=None):
+    """Generate `frame_stats` of files in order, computed in a pool of
+    `workers` threads (default: number of CPUs).
+    """
+    from multiprocessing.pool import ThreadPool
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(filenames) <= 1:
+        for fname in filenames:
+            yield frame_stats(fname, mask, engine)
+        return
+    pool = ThreadPool(min(workers, len(filenames)))
+    try:
+        for st in pool.imap(lambda f: frame_stats(f, mask, engine),
+                filenames):
+            yield st
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_stats(stats, fmt="csv", fout=sys.stdout):
+    """Write statistics dictionaries from `iter_stats` as CSV with a
+    header line or as JSON, one object per line.
+    """
+    if fmt == "csv":
+        import csv
+        w = csv.writer(fout)
+        w.writerow(stats_fields)
+        for st in stats:
+            w.writerow(["" if st[k] is None else st[k] for k in stats_fields])
+    elif fmt == "json":
+        for st in stats:
+            fout.write(json.dumps(st, sort_keys=True) + "\n")
+    else:
+        raise ValueError("Unknown format: %s" % fmt)
 
 
 def main():
@@ -73,9 +164,29 @@ def main():
     oprs.add_option("-o", "--output",
         action="store", type="string", dest="pngfile", default=None,
         help="Write the logarithm of the frame to a PNG file.")
+    oprs.add_option("-b", "--bin",
+        action="store", type="int", dest="bin", default=1,
+        help="Show 2D frames averaged over blocks of BIN x BIN pixels.")
+    oprs.add_option("-n", "--noplot",
+        action="store_true", dest="noplot", default=False,
+        help="Print the information without plotting.")
+    oprs.add_option("-s", "--stats",
+        action="store_true", dest="stats", default=False,
+        help="Print statistics of the data in many files without plotting.")
+    oprs.add_option("-f", "--format",
+        action="store", type="string", dest="format", default="csv",
+        help="Format of the statistics: csv or json (default csv).")
+    oprs.add_option("-j", "--workers",
+        action="store", type="int", dest="workers", default=None,
+        help="Number of threads for --stats (default: number of CPUs).")
+    oprs.add_option("-e", "--engine",
+        action="store", type="string", dest="engine", default=None,
+        help="Decoding engine: cbflib, numpy or mmap.")
     (opts, args) = oprs.parse_args()
     if(len(args) < 1):
         oprs.error("Input file argument required")
+    if opts.format not in ("csv", "json"):
+        oprs.error("Format must be csv or json")
 
     center = None
     if opts.center_str is not None:
@@ -90,24 +201,20 @@ def main():
     if opts.maskfile != None:
         mask = read_mask(opts.maskfile)
 
+    if opts.stats:
+        write_stats(iter_stats(args, mask, opts.workers, opts.engine),
+            opts.format)
+        return
+
     filename = args[0]
-    file_is_temporary = False
+    h = cbf.CBF()
     # FIXME: Use magic to detect file type.
-    if filename.endswith(".bz2"):
-        import bz2
-        fin = bz2.BZ2File(filename, mode='r')
-        fname = write_to_temp(fin)
-        file_is_temporary = True
-    elif filename.endswith(".gz"):
-        import gzip
-        fin = gzip.GzipFile(filename, mode='r')
-        fname = write_to_temp(fin)
-        file_is_temporary = True
+    if filename.endswith(".bz2") or filename.endswith(".gz"):
+        fin = open_compressed(filename)
+        h.read_fileobj(fin)
+        fin.close()
     else:
-        fname = filename
-
-    h = cbf.CBF()
-    h.read_file(fname)
+        h.read_file(filename)
     h.rewind_datablock()
     print("Found %s datablocks" % h.count_datablocks())
     h.select_datablock(0)
@@ -148,21 +255,31 @@ def main():
                     print("<binary>")
                     s=h.get_arrayparameters()
                     print(s)
-                    d, valtype = h.get()
+                    b = opts.bin
+                    if b > 1 and len(s["shape"]) == 2:
+                        d = h.get_binary(bin=(b, b), binmode="mean")
+                    else:
+                        b = 1
+                        d, valtype = h.get()
                     print d.shape
+                    if opts.noplot:
+                        continue
+                    import matplotlib.pylab as plt
                     if len(d.shape) == 1:
                         plt.semilogy(d)
                         plt.show()
                     elif len(d.shape) == 2:
                         if mask is not None:
-                            logim = np.log(np.abs(d*mask)+1)
+                            logim = np.log(np.abs(d*bin_mask(mask, b))+1)
                         else:
                             logim = np.log(np.abs(d)+1)
                         if opts.pngfile is not None:
+                            from xformats.detformats import write_pnglog
                             write_pnglog(logim, opts.pngfile)
                         plt.imshow(logim, interpolation='nearest')
                         if center is not None:
-                            mark_cross(center, color='white')
+                            mark_cross((center[0]/b, center[1]/b),
+                                color='white')
                         plt.show()
                     else:
                         print("Cannot show 3D arrays")
@@ -0,0 +1,207 @@
+# Author: Teemu Ikonen <teemu.ikonen@psi.ch>
+# Copyright: 2010 Paul Scherrer Institute
+# License:
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation; either version 2 of
+#   (the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+#   02111-1307  USA
+
+"""Follow a directory and decode CBF files as they are written.
+
+Example:
+
+ >>> for fname, frame in follow("/data/collect", "*.cbf", timeout=60): #doctest: +SKIP
+ ...     print(fname, frame.sum())
+"""
+
+import cbf, collections, ctypes, fnmatch, multiprocessing, os, select
+import struct, threading, time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+
+
+def is_complete(filename):
+    """Return True if the first binary section of a CBF file has been
+    completely written, i.e. the file size is at least the end of the
+    binary data declared in the header.
+    """
+    try:
+        hd = cbf.read_header(filename)
+        p = hd["parameters"]
+        if p is None:
+            return False
+        return os.path.getsize(filename) >= p["offset"] + p["size"]
+    except (IOError, OSError, KeyError, ValueError, RuntimeError):
+        return False
+
+
+class Inotify:
+    """Minimal ctypes interface to Linux inotify for one directory."""
+    def __init__(self, directory, mask=IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        path = directory if isinstance(directory, bytes) \
+            else directory.encode()
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def read(self, timeout):
+        """Return a list of (mask, name) events, waiting at most `timeout`
+        seconds for them.
+        """
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        buf = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos + 16 <= len(buf):
+            wd, mask, cookie, length = struct.unpack_from("iIII", buf, pos)
+            name = buf[pos+16:pos+16+length].rstrip(b"\0")
+            events.append((mask, cbf._str(name)))
+            pos += 16 + length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def follow(directory, pattern="*.cbf", interval=0.05, timeout=None,
+        existing=True, workers=None, engine=None, stop=None, use_inotify=True):
+    """Generate (filename, frame) tuples of CBF files in `directory` as
+    they are written.
+
+    New files matching the glob `pattern` are found with inotify, if it
+    is available and `use_inotify` is True, otherwise by listing the
+    directory every `interval` seconds. Files are decoded when
+    `is_complete` returns True for them, which is checked again only
+    when the size of the file changes, in a pool of `workers` threads
+    with `cbf.read_frame` and the given `engine`. Frames are generated in
+    the order the files were completed.
+
+    Files present when starting are also generated if `existing` is True.
+    The generator returns when no files have appeared or been completed
+    in `timeout` seconds (by default never), leaving incomplete files
+    unread, or when the threading.Event `stop` is set.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, workers))
+    notifier = None
+    if use_inotify:
+        try:
+            notifier = Inotify(directory)
+        except (AttributeError, OSError):
+            notifier = None
+    seen = set()
+    pending = set()
+    sizes = {}
+    decoding = collections.deque()
+    if existing:
+        pending.update(fnmatch.filter(os.listdir(directory), pattern))
+    else:
+        seen.update(fnmatch.filter(os.listdir(directory), pattern))
+    last_change = time.time()
+    next_scan = last_change
+    try:
+        while stop is None or not stop.is_set():
+            if notifier is not None:
+                names = [n for m, n in notifier.read(interval)]
+                names = fnmatch.filter(names, pattern)
+                scanned = True
+            else:
+                wait = next_scan - time.time()
+                if wait > 0:
+                    # Wait for the next scan or for the oldest frame
+                    if decoding:
+                        decoding[0][1].wait(wait)
+                    else:
+                        time.sleep(wait)
+                names = []
+                scanned = time.time() >= next_scan
+                if scanned:
+                    next_scan = time.time() + interval
+                    names = fnmatch.filter(os.listdir(directory), pattern)
+            new = set(names) - seen
+            if new:
+                last_change = time.time()
+                seen.update(new)
+                pending.update(new)
+            for name in (sorted(pending) if scanned else []):
+                fname = os.path.join(directory, name)
+                # Files are only checked again when their size changes
+                try:
+                    size = os.path.getsize(fname)
+                except OSError:
+                    continue
+                if sizes.get(name) == size:
+                    continue
+                sizes[name] = size
+                if is_complete(fname):
+                    last_change = time.time()
+                    pending.discard(name)
+                    del sizes[name]
+                    decoding.append((fname, pool.apply_async(cbf.read_frame,
+                        (fname, engine))))
+            while decoding and decoding[0][1].ready():
+                fname, res = decoding.popleft()
+                yield (fname, res.get())
+            if timeout is not None and not decoding \
+                    and time.time() - last_change > timeout:
+                break
+        while decoding:
+            fname, res = decoding.popleft()
+            yield (fname, res.get())
+    finally:
+        if notifier is not None:
+            notifier.close()
+        pool.close()
+
+
+class Follower(threading.Thread):
+    """Background thread putting frames from `follow` to a queue.
+
+    The (filename, frame) tuples are put to the attribute `queue`, which
+    holds at most `maxsize` frames, followed by None when following
+    ends. The keyword arguments are passed to `follow`. Call `stop` to
+    end following.
+    """
+    def __init__(self, directory, pattern="*.cbf", maxsize=0, **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue.Queue(maxsize)
+        self._stop_event = threading.Event()
+        self._args = (directory, pattern)
+        self._kwargs = kwargs
+
+    def run(self):
+        try:
+            for item in follow(*self._args, stop=self._stop_event,
+                    **self._kwargs):
+                self.queue.put(item)
+        finally:
+            self.queue.put(None)
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,265 @@
+# Author: Teemu Ikonen <teemu.ikonen@psi.ch>
+# Copyright: 2010 Paul Scherrer Institute
+# License:
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation; either version 2 of
+#   (the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+#   02111-1307  USA
+
+import cbf, hashlib, sys, threading
+import numpy as np
+from optparse import OptionParser
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+description="Integrate CBF frames radially around the beam center"
+
+usage="%prog [-c x,y] [-m mask] [-o output.npz] <file.cbf> [<file.cbf> ...]"
+
+
+class Integrator:
+    """Radial and azimuthal integration of frames of a given shape.
+
+    The pixel centers are at (x+0.5, y+0.5) for the pixel in column x
+    and row y, in the same coordinates as `center` = (x, y), see
+    cbfdump.parse_center. The radial bins are `binwidth` pixels wide and
+    the full circle is divided to `nsectors` azimuthal sectors, starting
+    from the positive x axis towards positive y.
+
+    Pixels which are False in the boolean `mask` are not used, and the
+    intensities are multiplied by `weights`, if given. The bin of each
+    pixel and the sum of weights in each bin are computed once, so that
+    integrating a frame is a single `numpy.bincount` or, if scipy is
+    available, a stack of frames is integrated with a single sparse
+    matrix product.
+
+    If `pixel_size` (m), `distance` (m) and `wavelength` (m) are given,
+    the attribute `q` has the mean scattering vector length 4 pi
+    sin(theta) / wavelength of the pixels in each radial bin in 1/m.
+    The attribute `radius` has the mean radius in pixels.
+    """
+    def __init__(self, shape, center, mask=None, binwidth=1.0, nsectors=1,
+            weights=None, pixel_size=None, distance=None, wavelength=None):
+        self.shape = tuple(shape)
+        self.center = tuple(center)
+        self.nsectors = nsectors
+        ny, nx = self.shape
+        y, x = np.indices(self.shape, dtype=np.float64)
+        x += 0.5 - center[0]
+        y += 0.5 - center[1]
+        r = np.sqrt(x**2 + y**2).reshape(-1)
+        rbin = (r / binwidth).astype(np.intp)
+        self.nbins = int(rbin.max()) + 1
+        if nsectors > 1:
+            phi = np.arctan2(y, x).reshape(-1) % (2*np.pi)
+            sector = np.minimum((phi * nsectors / (2*np.pi)).astype(np.intp),
+                nsectors - 1)
+            bins = sector*self.nbins + rbin
+        else:
+            bins = rbin
+        nb = nsectors*self.nbins
+        if mask is not None:
+            self.pixels = np.flatnonzero(np.asarray(mask).reshape(-1))
+        else:
+            self.pixels = np.arange(ny*nx)
+        self.bins = bins[self.pixels]
+        # Bin of every pixel, with the excluded pixels in an extra bin
+        self._index = np.empty(ny*nx, dtype=np.intp)
+        self._index.fill(nb)
+        self._index[self.pixels] = self.bins
+        self._fullweights = None
+        if weights is not None:
+            self._fullweights = np.asarray(weights,
+                dtype=np.float64).reshape(-1)
+            self.weights = self._fullweights[self.pixels]
+        else:
+            self.weights = None
+        self.norm = np.bincount(self.bins, self.weights, minlength=nb)
+        count = np.bincount(rbin[self.pixels], minlength=self.nbins)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.radius = np.bincount(rbin[self.pixels], r[self.pixels],
+                minlength=self.nbins) / count
+        self.q = None
+        if None not in (pixel_size, distance, wavelength):
+            twotheta = np.arctan(self.radius * pixel_size / distance)
+            self.q = 4*np.pi * np.sin(twotheta / 2) / wavelength
+        self._matrix = None
+        if scipy is not None:
+            data = self.weights
+            if data is None:
+                data = np.ones(len(self.pixels))
+            self._matrix = scipy.sparse.csr_matrix(
+                (data, (self.bins, self.pixels)), shape=(nb, ny*nx))
+
+    def sums(self, frames):
+        """Return the weighted sums of intensities in each bin.
+
+        `frames` is a frame or a stack of frames with shape
+        (nframes, ny, nx). The result has the shape (nbins,) for a single
+        frame and (nframes, nbins) for a stack, with nbins replaced by
+        (nsectors, nbins) if there is more than one sector.
+        """
+        frames = np.asarray(frames)
+        single = frames.ndim == 2
+        stack = frames.reshape((-1, self.shape[0]*self.shape[1]))
+        nb = self.nsectors*self.nbins
+        if self._matrix is not None:
+            out = np.asarray(self._matrix.dot(stack.T).T, dtype=np.float64)
+        else:
+            out = np.empty((len(stack), nb))
+            for i, frame in enumerate(stack):
+                if self._fullweights is not None:
+                    frame = frame * self._fullweights
+                out[i] = np.bincount(self._index, frame, minlength=nb+1)[:nb]
+        if self.nsectors > 1:
+            out = out.reshape((len(stack), self.nsectors, self.nbins))
+        return out[0] if single else out
+
+    def integrate(self, frames):
+        """Return the mean intensity in each bin of a frame or a stack.
+
+        Bins without pixels are NaN. See `sums` for the shape.
+        """
+        norm = self.norm
+        if self.nsectors > 1:
+            norm = norm.reshape((self.nsectors, self.nbins))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums(frames) / norm
+
+
+_integrators = {}
+_integrators_lock = threading.Lock()
+
+
+def integrator(shape, center, mask=None, **kwargs):
+    """Return an `Integrator`, reusing a previous one with the same shape,
+    center, mask and other arguments.
+    """
+    if kwargs.get("weights") is not None:
+        raise ValueError("Integrators with weights are not cached")
+    mkey = None
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        mkey = hashlib.md5(mask.tobytes()).hexdigest()
+    key = (tuple(shape), tuple(center), mkey, tuple(sorted(kwargs.items())))
+    _integrators_lock.acquire()
+    try:
+        integ = _integrators.get(key)
+    finally:
+        _integrators_lock.release()
+    if integ is None:
+        integ = Integrator(shape, center, mask, **kwargs)
+        _integrators_lock.acquire()
+        try:
+            if len(_integrators) > 16:
+                _integrators.clear()
+            _integrators[key] = integ
+        finally:
+            _integrators_lock.release()
+    return integ
+
+
+def header_geometry(hd):
+    """Return the keyword arguments center, pixel_size, distance and
+    wavelength of `Integrator` from a dictionary returned by
+    cbf.parse_header_contents. Missing values are None.
+    """
+    pixel_size = hd.get("pixel_size")
+    return {
+        "center" : hd.get("beam_xy"),
+        "pixel_size" : pixel_size[0] if pixel_size else None,
+        "distance" : hd.get("detector_distance"),
+        "wavelength" : hd.get("wavelength"),
+        }
+
+
+def integrate_files(filenames, center=None, mask=None, workers=None,
+        engine=None, chunksize=16, **kwargs):
+    """Return the radial integrals of the frames in a list of files.
+
+    The geometry is taken from the header of the first file, but
+    `center` and the other keyword arguments of `Integrator` override
+    it. The frames are read with cbf.read_stack `chunksize` files at a
+    time. Returns a dictionary with the keys "radius", "q" and "I",
+    which has the mean intensities with shape (nframes, nbins).
+    """
+    geom = header_geometry(cbf.parse_header_contents(
+        cbf.read_header(filenames[0])["header_contents"] or ""))
+    if center is not None:
+        geom["center"] = center
+    if geom["center"] is None:
+        raise ValueError("Beam center is not given or in the header")
+    geom.update(kwargs)
+    integ = None
+    res = []
+    for i in range(0, len(filenames), chunksize):
+        frames = cbf.read_stack(filenames[i:i+chunksize], workers, engine)
+        if integ is None:
+            integ = integrator(frames.shape[1:], mask=mask, **geom)
+        res.append(integ.integrate(frames))
+    return {
+        "radius" : integ.radius,
+        "q" : integ.q,
+        "I" : np.concatenate(res),
+        }
+
+
+def main():
+    from cbfdump import parse_center
+    from cbfreduce import read_mask
+    oprs = OptionParser(usage=usage, description=description)
+    oprs.add_option("-m", "--maskfile",
+        action="store", type="string", dest="maskfile", default=None)
+    oprs.add_option("-c", "--center",
+        action="store", type="string", dest="center_str", default=None,
+        help="Beam center x,y in pixels (default: from the header).")
+    oprs.add_option("-b", "--binwidth",
+        action="store", type="float", dest="binwidth", default=1.0,
+        help="Width of the radial bins in pixels (default 1).")
+    oprs.add_option("-s", "--sectors",
+        action="store", type="int", dest="nsectors", default=1,
+        help="Number of azimuthal sectors (default 1).")
+    oprs.add_option("-o", "--output",
+        action="store", type="string", dest="outfile", default="integ.npz",
+        help="Write the integrals to a .npz file (default integ.npz).")
+    oprs.add_option("-j", "--workers",
+        action="store", type="int", dest="workers", default=None,
+        help="Number of reading threads (default: number of CPUs).")
+    oprs.add_option("-e", "--engine",
+        action="store", type="string", dest="engine", default=None,
+        help="Decoding engine: cbflib, numpy or mmap.")
+    (opts, args) = oprs.parse_args()
+    if len(args) < 1:
+        oprs.error("Input file argument required")
+
+    center = None
+    if opts.center_str is not None:
+        center = parse_center(opts.center_str)
+        if center is None:
+            oprs.error("Could not parse the center.")
+    mask = None
+    if opts.maskfile is not None:
+        mask = read_mask(opts.maskfile)
+    res = integrate_files(args, center, mask, opts.workers, opts.engine,
+        binwidth=opts.binwidth, nsectors=opts.nsectors)
+    np.savez(opts.outfile, **dict((k, v) for k, v in res.items()
+        if v is not None))
+    sys.stdout.write("Integrated %d frames to %s\n"
+        % (len(res["I"]), opts.outfile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# Author: Teemu Ikonen <teemu.ikonen@psi.ch>
+# Copyright: 2010 Paul Scherrer Institute
+# License:
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation; either version 2 of
+#   (the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+#   02111-1307  USA
+
+import cbf, ctypes, multiprocessing, time
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class FrameRing:
+    """A ring buffer of frame slots in memory shared between processes.
+
+    The slots are in a multiprocessing.RawArray, which is given to the
+    processes when they are started. A producer takes a free slot with
+    `acquire`, which blocks while all the slots are in use, decodes a
+    frame into the array `frame(slot)` and hands it to the consumers
+    with `put`. A consumer gets the slot index with `get`, uses the
+    array, which is a view to the shared memory, and returns the slot
+    with `release`. Only the slot indices are passed through queues.
+
+    The numbers of frames, the current and maximum numbers of occupied
+    slots, the mean occupancy when frames are put and the times the
+    producers and consumers have waited are returned by `asdict`.
+    """
+    def __init__(self, nslots, shape, dtype):
+        self.nslots = nslots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slotsize = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._raw = multiprocessing.RawArray(ctypes.c_char,
+            max(1, nslots*self.slotsize))
+        self._free = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue()
+        for i in range(nslots):
+            self._free.put(i)
+        # frames, occupied, max occupied, sum of occupied at put,
+        # producer wait, consumer wait
+        self._stats = multiprocessing.Array(ctypes.c_double, 6)
+
+    def frame(self, slot):
+        """Return the array in `slot` as a view to the shared memory."""
+        return np.frombuffer(self._raw, dtype=self.dtype,
+            count=int(np.prod(self.shape)),
+            offset=slot*self.slotsize).reshape(self.shape)
+
+    def acquire(self):
+        """Return the index of a free slot, waiting until one is free."""
+        t0 = time.time()
+        slot = self._free.get()
+        st = self._stats
+        with st.get_lock():
+            st[4] += time.time() - t0
+            st[1] += 1
+            st[2] = max(st[2], st[1])
+        return slot
+
+    def put(self, slot, info=None):
+        """Pass a filled `slot` and a picklable `info` to the consumers."""
+        st = self._stats
+        with st.get_lock():
+            st[0] += 1
+            st[3] += st[1]
+        self._ready.put((slot, info))
+
+    def get(self, timeout=None):
+        """Return the next filled slot and its info as a tuple, raising
+        queue.Empty if there is none in `timeout` seconds.
+        """
+        t0 = time.time()
+        try:
+            return self._ready.get(timeout=timeout)
+        finally:
+            st = self._stats
+            with st.get_lock():
+                st[5] += time.time() - t0
+
+    def release(self, slot):
+        """Return a slot which is no longer used to the free slots."""
+        st = self._stats
+        with st.get_lock():
+            st[1] -= 1
+        self._free.put(slot)
+
+    def asdict(self):
+        """Return the occupancy statistics as a dictionary with keys
+        "slots", "frames", "occupied", "max_occupied", "mean_occupied",
+        "producer_wait" and "consumer_wait" (in seconds).
+        """
+        st = self._stats
+        with st.get_lock():
+            frames, occ, maxocc, occsum, pwait, cwait = st[:]
+        return {
+            "slots" : self.nslots,
+            "frames" : int(frames),
+            "occupied" : int(occ),
+            "max_occupied" : int(maxocc),
+            "mean_occupied" : occsum / frames if frames else 0.0,
+            "producer_wait" : pwait,
+            "consumer_wait" : cwait,
+            }
+
+
+def _worker(ring, tasks, engine, native):
+    """Decode the files from the queue `tasks` into slots of `ring`."""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        i, fname = task
+        slot = ring.acquire()
+        try:
+            cbf.read_frame(fname, engine, native, out=ring.frame(slot))
+            err = None
+        except Exception as e:
+            err = e
+        ring.put(slot, (i, fname, err))
+
+
+class Pipeline:
+    """Decode a list of CBF files in a pool of processes into a
+    `FrameRing` of `nslots` slots.
+
+    The worker processes (by default one per CPU) read the frames with
+    cbf.read_frame and `engine`, which with CBFlib decodes with
+    cbf_get_integerarray directly into the shared slot. Iterating over
+    the pipeline generates tuples (index, filename, array) in the order
+    the frames are decoded, where the array is a view to the slot, valid
+    until the next iteration. The workers wait for free slots, when the
+    consumer is slower than them.
+
+    The shape and type of the frames are taken from the header of the
+    first file, see cbf.binary_dtype for `native`. The `ring` attribute
+    has the occupancy statistics, and can also be given to other
+    processes consuming the frames. While waiting for frames, the
+    workers are checked every `poll` seconds, and RuntimeError is raised
+    if they have all exited with frames still missing.
+    """
+    def __init__(self, filenames, nslots=8, workers=None, engine=None,
+            native=False, poll=1.0):
+        self.filenames = list(filenames)
+        self.poll = poll
+        p = cbf.read_header(self.filenames[0])["parameters"]
+        self.ring = FrameRing(nslots, p["shape"],
+            cbf.binary_dtype(p, native))
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._tasks = multiprocessing.Queue()
+        for task in enumerate(self.filenames):
+            self._tasks.put(task)
+        self._procs = []
+        for i in range(workers):
+            self._tasks.put(None)
+            proc = multiprocessing.Process(target=_worker,
+                args=(self.ring, self._tasks, engine, native))
+            proc.daemon = True
+            proc.start()
+            self._procs.append(proc)
+
+    def __iter__(self):
+        try:
+            for k in range(len(self.filenames)):
+                slot, (i, fname, err) = self._get()
+                try:
+                    if err is not None:
+                        raise err
+                    yield i, fname, self.ring.frame(slot)
+                finally:
+                    self.ring.release(slot)
+        finally:
+            self.close()
+
+    def _get(self):
+        """Return the next filled slot from the ring, checking that the
+        workers are alive while waiting.
+        """
+        while True:
+            # Frames from workers which have exited are already queued
+            alive = any(proc.is_alive() for proc in self._procs)
+            try:
+                return self.ring.get(timeout=self.poll)
+            except queue.Empty:
+                if not alive:
+                    raise RuntimeError("Worker processes exited before "
+                        "decoding all frames")
+
+    def close(self, timeout=5.0):
+        """Stop the worker processes.
+
+        The files not yet started are skipped and the workers are asked
+        to stop. The slots of frames which have not been read are
+        released for the workers waiting for them. Workers which have
+        not exited in `timeout` seconds are terminated.
+        """
+        if not self._procs:
+            return
+        try:
+            while True:
+                self._tasks.get_nowait()
+        except queue.Empty:
+            pass
+        for proc in self._procs:
+            self._tasks.put(None)
+        deadline = time.time() + timeout
+        while (any(proc.is_alive() for proc in self._procs)
+                and time.time() < deadline):
+            try:
+                slot, info = self.ring.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            self.ring.release(slot)
+        for proc in self._procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        self._procs = []
@@ -0,0 +1,189 @@
+# Author: Teemu Ikonen <teemu.ikonen@psi.ch>
+# Copyright: 2010 Paul Scherrer Institute
+# License:
+#   This program is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU General Public License as
+#   published by the Free Software Foundation; either version 2 of
+#   (the License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+#   02111-1307  USA
+
+import cbf, multiprocessing, sys, threading
+import numpy as np
+from optparse import OptionParser
+
+description="Compute sum, mean, maximum and variance images of CBF files"
+
+usage="%prog [-o output.npz] <file.cbf> [<file.cbf> ...]"
+
+
+class Accumulator:
+    """Running sum, mean, maximum and variance of a series of frames.
+
+    Frames are added with `add` and accumulators of different parts of
+    a series are combined with `merge`. The mean and variance are
+    accumulated with the method of Welford and Chan et al., which is
+    numerically stable for long series.
+    """
+    def __init__(self):
+        self.n = 0
+        self.sum = None
+        self.max = None
+        self.mean = None
+        self.m2 = None
+
+    def add(self, frame):
+        """Add a frame to the accumulator."""
+        if self.n == 0:
+            sumtype = np.float64 if frame.dtype.kind == "f" else np.int64
+            self.sum = frame.astype(sumtype)
+            self.max = frame.copy()
+            self.mean = frame.astype(np.float64)
+            self.m2 = np.zeros(frame.shape, dtype=np.float64)
+            self.n = 1
+            return
+        self.n += 1
+        self.sum += frame
+        np.maximum(self.max, frame, out=self.max)
+        delta = frame - self.mean
+        self.mean += delta / self.n
+        delta *= (frame - self.mean)
+        self.m2 += delta
+
+    def merge(self, other):
+        """Add the frames accumulated in `other` to this accumulator.
+
+        Returns self.
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.__dict__.update(other.__dict__)
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2 * (float(self.n) * other.n / n)
+        self.mean += delta * (float(other.n) / n)
+        self.sum += other.sum
+        np.maximum(self.max, other.max, out=self.max)
+        self.n = n
+        return self
+
+    def result(self, mask=None):
+        """Return a dictionary with keys "n", "sum", "mean", "max" and
+        "var" (population variance).
+
+        If a boolean `mask` is given, pixels where it is False are zero.
+        """
+        res = {
+            "n" : self.n,
+            "sum" : self.sum,
+            "mean" : self.mean,
+            "max" : self.max,
+            "var" : self.m2 / max(self.n, 1),
+            }
+        if mask is not None:
+            for key in ["sum", "mean", "max", "var"]:
+                res[key] = np.where(mask, res[key], 0).astype(res[key].dtype)
+        return res
+
+
+def tree_reduce(accumulators):
+    """Merge a list of accumulators pairwise and return the result."""
+    accs = list(accumulators)
+    while len(accs) > 1:
+        merged = [accs[i].merge(accs[i+1]) for i in range(0, len(accs)-1, 2)]
+        if len(accs) % 2:
+            merged.append(accs[-1])
+        accs = merged
+    return accs[0]
+
+
+def reduce_frames(filenames, mask=None, workers=None, engine=None):
+    """Return the sum, mean, maximum and variance of frames in files.
+
+    The files are read with `cbf.read_frame` by a pool of `workers`
+    threads (by default the number of CPUs). Each thread decodes into
+    its own frame buffer and accumulates its own `Accumulator`, so the
+    memory use does not depend on the number of files. The accumulators
+    are merged with `tree_reduce`. See `Accumulator.result` for the
+    returned dictionary and `mask`.
+    """
+    if not filenames:
+        raise ValueError("No files to reduce")
+    files = iter(filenames)
+    lock = threading.Lock()
+    def work(_):
+        acc = Accumulator()
+        buf = None
+        while True:
+            lock.acquire()
+            try:
+                fname = next(files, None)
+            finally:
+                lock.release()
+            if fname is None:
+                return acc
+            frame = cbf.read_frame(fname, engine, out=buf)
+            # Frames mapped from uncompressed files are read-only
+            buf = frame if frame.flags.writeable else None
+            acc.add(frame)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(filenames)))
+    if workers == 1:
+        accs = [work(0)]
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            accs = pool.map(work, range(workers))
+        finally:
+            pool.close()
+            pool.join()
+    return tree_reduce(accs).result(mask)
+
+
+def read_mask(fname):
+    """Read a boolean mask from a .npy file or from an image file."""
+    if fname.endswith(".npy"):
+        return np.load(fname).astype(bool)
+    from cbfdump import read_mask as read_image_mask
+    return read_image_mask(fname)
+
+
+def main():
+    oprs = OptionParser(usage=usage, description=description)
+    oprs.add_option("-m", "--maskfile",
+        action="store", type="string", dest="maskfile", default=None)
+    oprs.add_option("-o", "--output",
+        action="store", type="string", dest="outfile", default="reduced.npz",
+        help="Write the images to a .npz file (default reduced.npz).")
+    oprs.add_option("-j", "--workers",
+        action="store", type="int", dest="workers", default=None,
+        help="Number of reading threads (default: number of CPUs).")
+    oprs.add_option("-e", "--engine",
+        action="store", type="string", dest="engine", default=None,
+        help="Decoding engine: cbflib, numpy or mmap.")
+    (opts, args) = oprs.parse_args()
+    if len(args) < 1:
+        oprs.error("Input file argument required")
+
+    mask = None
+    if opts.maskfile is not None:
+        mask = read_mask(opts.maskfile)
+    res = reduce_frames(args, mask, opts.workers, opts.engine)
+    np.savez(opts.outfile, **res)
+    sys.stdout.write("Reduced %d frames to %s\n" % (res["n"], opts.outfile))
+
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,41 @@
 #   Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
 #   02111-1307  USA
 
-import doctest, cbf
+import doctest, cbf, cbfbench, cbfconvert, cbfdump, cbffollow, cbfinteg
+import cbfreduce
+import os, shutil, tempfile, threading, time
+import numpy as np
+
+
+def write_uncompressed(arr):
+    """Write `arr` to an uncompressed temporary CBF file, return its name.
+    """
+    eltype = "%s %d-bit integer" % (
+        "unsigned" if arr.dtype.kind == "u" else "signed", 8*arr.itemsize)
+    header = "\r\n".join([
+        "###CBF: VERSION 1.5",
+        "data_uncompressed",
+        "_array_data.data",
+        ";",
+        "--CIF-BINARY-FORMAT-SECTION--",
+        "Content-Type: application/octet-stream;",
+        '     conversions="x-CBF_NONE"',
+        "Content-Transfer-Encoding: BINARY",
+        "X-Binary-Size: %d" % arr.nbytes,
+        "X-Binary-ID: 1",
+        'X-Binary-Element-Type: "%s"' % eltype,
+        "X-Binary-Element-Byte-Order: LITTLE_ENDIAN",
+        "X-Binary-Number-of-Elements: %d" % arr.size,
+        "X-Binary-Size-Fastest-Dimension: %d" % arr.shape[1],
+        "X-Binary-Size-Second-Dimension: %d" % arr.shape[0],
+        "", ""])
+    fd, fname = tempfile.mkstemp(suffix=".cbf")
+    f = os.fdopen(fd, "wb")
+    f.write(header.encode("ascii") + b"\x0c\x1a\x04\xd5")
+    f.write(arr.astype(arr.dtype.newbyteorder("<")).tobytes())
+    f.write(b"\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n")
+    f.close()
+    return fname
 
 
 def doctest_readme_test():
@@ -34,6 +68,707 @@ def datablocks_test():
     ll = h.datablocks()
 
 
+def lazy_datablocks_test():
+    h = cbf.CBF("testdata/agbeh_long.cbf")
+    blocks = h.datablocks(lazy=True)
+    lazy = blocks[0]['categories'][0]['values']['data'][0]
+    assert isinstance(lazy, cbf.LazyArray)
+    assert lazy.params["shape"] == (1679, 1475)
+    assert lazy._value is None
+    a = np.asarray(lazy)
+    assert lazy.shape == (1679, 1475)
+    assert np.all(a == cbf.read_binary("testdata/agbeh_long.cbf"))
+    lazy.release()
+    assert lazy._value is None
+
+
+def close_and_reuse_test():
+    with cbf.CBF("testdata/agbeh_long.cbf") as h:
+        name = h.datablocks()[0]["name"]
+        h.read_file("testdata/agbeh_long.cbf")
+        assert h.count_datablocks() == 1
+        assert h.datablocks()[0]["name"] == name
+        h.reset()
+        assert h.count_datablocks() == 0
+    assert not h.h
+    h.close()
+
+
+def typed_category_test():
+    assert np.all(cbf._typed_column(["1", "2", "-3"]) == [1, 2, -3])
+    col = cbf._typed_column(["1.5", ".", "2e3"])
+    assert col.dtype == np.float64 and np.isnan(col[1]) and col[2] == 2000.0
+    assert cbf._typed_column(["a", "1"]) == ["a", "1"]
+    h = cbf.CBF("testdata/agbeh_long.cbf")
+    cd = h.category_asdict("array_data", typed=True)
+    assert cd["values"]["header_convention"] == ["SLS_1.0"]
+    assert cd["values"]["data"][0].shape == (1679, 1475)
+
+
+def iter_arrays_test():
+    fname = write_uncompressed(np.arange(12, dtype=np.int32).reshape(3, 4))
+    try:
+        h = cbf.CBF(fname)
+        items = [(b, c, col, r, a.copy()) for b, c, col, r, a
+            in h.iter_arrays(reuse=True)]
+        assert len(items) == 1
+        assert items[0][:4] == ("uncompressed", "array_data", "data", 0)
+        assert np.all(items[0][4] == np.arange(12).reshape(3, 4))
+        h = cbf.CBF("testdata/agbeh_long.cbf")
+        for b, c, col, r, a in h.iter_arrays(engine="numpy"):
+            h.datablocks()
+            assert a.shape == (1679, 1475)
+    finally:
+        os.remove(fname)
+
+
+def real_array_test():
+    a = np.linspace(-1.0, 1.0, 12).reshape(3, 4)
+    fd, fname = tempfile.mkstemp(suffix=".cbf")
+    os.close(fd)
+    try:
+        cbf.write_frame(fname, a)
+        h = cbf.CBF(fname)
+        h.find_category("array_data")
+        h.find_column("data")
+        for engine in ["cbflib", "numpy"]:
+            b = h.get_binary(engine)
+            assert b.dtype == np.float64 and np.all(b == a)
+        cbf.write_frame(fname, a.astype(np.float32))
+        h.read_file(fname)
+        h.find_category("array_data")
+        h.find_column("data")
+        for engine in ["cbflib", "numpy"]:
+            b = h.get_binary(engine, native=True)
+            assert b.dtype == np.float32 and np.all(b == a.astype(np.float32))
+        h.close()
+    finally:
+        os.remove(fname)
+
+
+def engines_test():
+    h = cbf.CBF("testdata/agbeh_long.cbf")
+    h.find_category("array_data")
+    h.find_column("data")
+    a = h.get_binary(engine="cbflib")
+    b = h.get_binary(engine="numpy")
+    assert a.dtype == b.dtype
+    assert np.all(a == b)
+    out = np.empty(a.shape, dtype=np.int16)
+    h.get_binary(engine="cbflib", out=out)
+    assert np.all(out == a.astype(np.int16))
+
+
+def unsupported_compression_test():
+    raw = cbf.map_file("testdata/agbeh_long.cbf")
+    p = dict(next(cbf.binary_sections(raw)))
+    p["compression"] = cbf.Compression.CBF_PACKED
+    for decode in [lambda: cbf.decode_binary(raw, p),
+            lambda: cbf.decode_binary(raw, p, roi=(slice(0, 2),)),
+            lambda: cbf.decode_binned(raw, p, (2, 2))]:
+        try:
+            decode()
+            assert False
+        except RuntimeError as e:
+            assert e.args[0] == cbf.Errors.CBF_NOTIMPLEMENTED
+
+
+def read_bytes_test():
+    f = open("testdata/agbeh_long.cbf", "rb")
+    buf = f.read()
+    f.close()
+    h = cbf.CBF()
+    h.read_bytes(buf)
+    a = h.datablocks()
+    h = cbf.CBF()
+    h.read_bytes(bytearray(buf))
+    b = h.datablocks()
+    assert a[0]["name"] == b[0]["name"]
+    assert np.all(a[0]["categories"][0]["values"]["data"][0]
+        == b[0]["categories"][0]["values"]["data"][0])
+    # Values read from file objects are not cached by name
+    f = open("testdata/agbeh_long.cbf", "rb")
+    h.read_fileobj(f)
+    f.close()
+    assert h.filename is None
+    # CBFlib closes the stream of a file it fails to read
+    fd, fname = tempfile.mkstemp(suffix=".cbf")
+    os.write(fd, buf[:len(buf)//2])
+    os.close(fd)
+    try:
+        for read, arg in [(h.read_bytes, b"garbage"),
+                (h.read_bytes, buf[:len(buf)//2]), (h.read_file, fname)]:
+            try:
+                read(arg)
+            except RuntimeError:
+                pass
+            else:
+                assert False
+        h.close()
+    finally:
+        os.remove(fname)
+
+
+def read_binary_test():
+    a = cbf.read_binary("testdata/agbeh_long.cbf")
+    assert a.shape == (1679, 1475)
+    assert a.dtype == np.int32
+    assert a[0,-3:].tolist() == [0, 2, 1]
+    assert a[-1,-3:].tolist() == [1, 4, 4]
+
+
+def read_binary_mmap_test():
+    arr = np.arange(12, dtype=np.uint16).reshape((3, 4))
+    fname = write_uncompressed(arr)
+    try:
+        v = cbf.read_binary(fname, copy=False)
+        assert not v.flags.writeable
+        assert v.dtype == np.dtype("<u2")
+        assert np.all(v == arr)
+        c = cbf.read_binary(fname)
+        assert c.dtype == np.uint32
+        assert np.all(c == arr)
+    finally:
+        os.remove(fname)
+
+
+def native_and_out_test():
+    arr = np.arange(12, dtype=np.uint16).reshape((3, 4))
+    fname = write_uncompressed(arr)
+    try:
+        a = cbf.read_binary(fname, native=True)
+        assert a.dtype == np.uint16
+        assert a.flags.writeable
+        assert np.all(a == arr)
+    finally:
+        os.remove(fname)
+    ref = cbf.read_binary("testdata/agbeh_long.cbf")
+    stack = np.zeros((2,) + ref.shape, dtype=np.int32)
+    a = cbf.read_binary("testdata/agbeh_long.cbf", out=stack[1])
+    assert a.base is stack
+    assert np.all(stack[1] == ref) and np.all(stack[0] == 0)
+    strided = np.zeros((ref.shape[0], 2*ref.shape[1]), dtype=np.int64)
+    cbf.read_binary("testdata/agbeh_long.cbf", out=strided[:,::2])
+    assert np.all(strided[:,::2] == ref) and np.all(strided[:,1::2] == 0)
+
+
+def read_stack_test():
+    fnames = 3*["testdata/agbeh_long.cbf"]
+    ref = cbf.read_binary(fnames[0])
+    for workers in [1, 3]:
+        stack = cbf.read_stack(fnames, workers=workers, engine="numpy")
+        assert stack.shape == (3,) + ref.shape
+        assert np.all(stack == ref)
+
+
+def accumulator_test():
+    frames = np.random.RandomState(0).poisson(10.0, (7, 5, 4)).astype(np.int32)
+    accs = []
+    for i in range(0, 7, 3):
+        acc = cbfreduce.Accumulator()
+        for f in frames[i:i+3]:
+            acc.add(f)
+        accs.append(acc)
+    res = cbfreduce.tree_reduce(accs).result()
+    assert res["n"] == 7
+    assert np.all(res["sum"] == frames.sum(axis=0))
+    assert np.all(res["max"] == frames.max(axis=0))
+    assert np.allclose(res["mean"], frames.mean(axis=0))
+    assert np.allclose(res["var"], frames.var(axis=0))
+
+
+def reduce_frames_test():
+    ref = cbf.read_binary("testdata/agbeh_long.cbf")
+    mask = np.ones(ref.shape, dtype=bool)
+    mask[0,:] = False
+    res = cbfreduce.reduce_frames(3*["testdata/agbeh_long.cbf"], mask=mask,
+        workers=2, engine="numpy")
+    assert res["n"] == 3
+    assert np.all(res["sum"][1:] == 3*ref[1:])
+    assert np.all(res["sum"][0] == 0)
+    assert np.all(res["max"][1:] == ref[1:])
+    assert np.all(res["var"] == 0)
+    d = tempfile.mkdtemp()
+    try:
+        fnames = cbfbench.write_synthetic(d, "pilatus300k", 3,
+            compressed=False)
+        res = cbfreduce.reduce_frames(fnames, workers=1, engine="mmap")
+        assert res["n"] == 3
+        assert np.all(res["sum"] == sum(cbf.read_binary(f) for f in fnames))
+    finally:
+        shutil.rmtree(d)
+    try:
+        cbfreduce.reduce_frames([])
+        assert False
+    except ValueError:
+        pass
+
+
+def read_header_test():
+    hd = cbf.read_header("testdata/agbeh_long.cbf", blocksize=256)
+    assert hd["name"] == "e12608_1_00016_00000_00000"
+    assert hd["header_convention"] == "SLS_1.0"
+    assert hd["header_contents"].startswith("# Detector: PILATUS 2M")
+    assert "# Exposure_time 0.500000 s\n" in hd["header_contents"]
+    assert hd["parameters"]["shape"] == (1679, 1475)
+    assert hd["parameters"]["compression"] == cbf.Compression.CBF_BYTE_OFFSET
+
+
+def parse_header_contents_test():
+    text = cbf.read_header("testdata/agbeh_long.cbf")["header_contents"]
+    hd = cbf.parse_header_contents(text)
+    assert hd["detector"] == "PILATUS 2M - SN01"
+    assert hd["timestamp"] == "2010/Feb/25 17:45:09.320"
+    assert hd["exposure_time"] == 0.5
+    assert hd["pixel_size"] == (172e-6, 172e-6)
+    assert hd["count_cutoff"] == 1541621
+    assert abs(hd["thickness"] - 320e-6) < 1e-12
+    hd["detector"] = None
+    assert cbf.parse_header_contents(text)["detector"] == "PILATUS 2M - SN01"
+    hd = cbf.parse_header_contents("# Wavelength 1.0000 A\n"
+        "# Detector_distance 150.00 mm\n"
+        "# Beam_xy (1231.00, 1263.50) pixels\n")
+    assert abs(hd["wavelength"] - 1e-10) < 1e-20
+    assert abs(hd["detector_distance"] - 0.15) < 1e-12
+    assert hd["beam_xy"] == (1231.0, 1263.5)
+
+
+def write_frame_test():
+    ref = cbf.read_binary("testdata/agbeh_long.cbf")
+    header = cbf.read_header("testdata/agbeh_long.cbf")
+    fd, fname = tempfile.mkstemp(suffix=".cbf")
+    os.close(fd)
+    try:
+        cbf.write_frame(fname, ref, header["header_contents"], name="test")
+        hd = cbf.read_header(fname)
+        assert hd["name"] == "test"
+        assert hd["header_contents"] == header["header_contents"]
+        assert hd["parameters"]["size"] == header["parameters"]["size"]
+        assert hd["parameters"]["md5"] == header["parameters"]["md5"]
+        assert np.all(cbf.read_binary(fname) == ref)
+        arr = np.linspace(0, 1, 12).reshape((2, 2, 3))
+        cbf.write_frame(fname, arr)
+        assert np.all(cbf.read_binary(fname) == arr)
+    finally:
+        os.remove(fname)
+
+
+def encode_byte_offset_test():
+    vals = np.array([0, 1, 128, 0, 127, -1, 40000, -40000, 2**33, -2**33, 0])
+    data = cbf.encode_byte_offset(vals)
+    dec = cbf.decode_byte_offset(data, len(vals), dtype=np.int64)
+    assert np.all(dec == vals)
+
+
+def follow_test():
+    d = tempfile.mkdtemp()
+    try:
+        f = open("testdata/agbeh_long.cbf", "rb")
+        src = f.read()
+        f.close()
+        f = open(os.path.join(d, "a.cbf"), "wb")
+        f.write(src)
+        f.close()
+        f = open(os.path.join(d, "b.cbf"), "wb")
+        f.write(src[:len(src)//2])
+        f.close()
+        assert cbffollow.is_complete(os.path.join(d, "a.cbf"))
+        assert not cbffollow.is_complete(os.path.join(d, "b.cbf"))
+        for inotify in [True, False]:
+            got = [os.path.basename(fname) for fname, frame
+                in cbffollow.follow(d, timeout=0.2, engine="numpy",
+                    use_inotify=inotify)]
+            assert got == ["a.cbf"]
+        # Complete b.cbf while following, counting the directory scans
+        listdir = os.listdir
+        scans = []
+        def counting_listdir(path):
+            scans.append(path)
+            return listdir(path)
+        def complete():
+            f = open(os.path.join(d, "b.cbf"), "ab")
+            f.write(src[len(src)//2:])
+            f.close()
+        threading.Timer(0.2, complete).start()
+        os.listdir = counting_listdir
+        try:
+            got = [os.path.basename(fname) for fname, frame
+                in cbffollow.follow(d, interval=0.05, timeout=0.5,
+                    engine="numpy", use_inotify=False)]
+        finally:
+            os.listdir = listdir
+        assert got == ["a.cbf", "b.cbf"]
+        assert len(scans) < 30
+    finally:
+        shutil.rmtree(d)
+
+
+def synthetic_frames_test():
+    d = tempfile.mkdtemp()
+    try:
+        for compressed in [True, False]:
+            fnames = cbfbench.write_synthetic(d, "pilatus300k", 2, compressed)
+            a = cbf.read_binary(fnames[1])
+            assert a.shape == cbfbench.detector_shapes["pilatus300k"]
+            assert np.median(a) <= 1 and a.max() > 1000
+            hd = cbf.parse_header_contents(
+                cbf.read_header(fnames[1])["header_contents"])
+            assert hd["frame"] == "1"
+    finally:
+        shutil.rmtree(d)
+
+
+def stats_test():
+    phases = []
+    cbf.stats = cbf.Stats(lambda phase, t, n: phases.append(phase))
+    try:
+        cbf.read_header("testdata/agbeh_long.cbf")
+        cbf.read_binary("testdata/agbeh_long.cbf",
+            out=np.empty((1679, 1475), dtype=np.float32))
+        d = cbf.stats.asdict()
+    finally:
+        cbf.stats = None
+    assert phases == ["header", "fopen", "parse", "decode", "convert"]
+    assert d["calls"]["decode"] == 1
+    assert d["nbytes"]["decode"] == 1679*1475*4
+    assert d["nbytes"]["convert"] == 1679*1475*4
+    assert d["times"]["decode"] > 0
+    st = cbf.Stats()
+    def count():
+        for i in range(10000):
+            st.count("cbflib_calls")
+    threads = [threading.Thread(target=count) for i in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert st.asdict()["counters"]["cbflib_calls"] == 40000
+
+
+def roi_test():
+    a = cbf.read_binary("testdata/agbeh_long.cbf")
+    d = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(d, "a.cbf")
+        shutil.copy("testdata/agbeh_long.cbf", fname)
+        for roi in [(slice(800, 850), slice(700, 750)), (slice(1678, None),),
+                (slice(10, 2, -2), 3)]:
+            assert np.all(cbf.read_binary(fname, roi=roi) == a[roi])
+            assert np.all(cbf.read_binary(fname, roi=roi, sidecar=True)
+                == a[roi])
+        assert os.path.exists(cbf.checkpoint_file(fname))
+        os.remove(cbf.checkpoint_file(fname))
+        roi = (slice(800, 850), slice(700, 750))
+        s = cbf.read_stack([fname]*2, workers=1, roi=roi, sidecar=True)
+        assert np.all(s == a[roi])
+        assert os.path.exists(cbf.checkpoint_file(fname))
+    finally:
+        shutil.rmtree(d)
+    # Regions are not slower to read than the whole frame
+    fname = "testdata/agbeh_long.cbf"
+    def best(*args, **kwargs):
+        times = []
+        for i in range(5):
+            t0 = time.time()
+            b = cbf.read_frame(fname, *args, **kwargs)
+            times.append(time.time() - t0)
+        return min(times)
+    full = best()
+    for roi in [(slice(0, 50),), (slice(800, 850), slice(700, 750)),
+            (slice(1600, None),)]:
+        assert np.all(cbf.read_frame(fname, roi=roi) == a[roi])
+        assert np.all(cbf.read_frame(fname, "numpy", roi=roi) == a[roi])
+        assert best(roi=roi) < 1.5*full + 0.002
+    if cbf.lib is not None:
+        roi = (slice(800, 850),)
+        with cbf.CBF(fname) as h:
+            h.find_category("array_data")
+            h.find_column("data")
+            h.select_row(0)
+            assert np.all(h.get_binary(roi=roi) == a[roi])
+            assert list(h._checkpoints.values()) == [None]
+            assert np.all(h.get_binary(roi=roi) == a[roi])
+            assert list(h._checkpoints.values())[0] is not None
+    raw = np.frombuffer(cbf.encode_byte_offset(a), dtype=np.uint8)
+    ind = cbf.byte_offset_index(raw, a.size, a.shape[1])
+    b = cbf.decode_byte_offset(raw[ind[0,100]:ind[0,110]], 10*a.shape[1],
+        initial=ind[1,100])
+    assert np.all(b == a[100:110].reshape(-1))
+
+
+def frame_cache_test():
+    fname = "testdata/agbeh_long.cbf"
+    a = cbf.read_binary(fname)
+    cache = cbf.FrameCache(maxbytes=a.nbytes + 1000)
+    s = cbf.read_stack([fname]*3, workers=1, engine="numpy", cache=cache)
+    assert np.all(s[2] == a)
+    assert (cache.hits, cache.misses, len(cache)) == (2, 1, 1)
+    b = cbf.read_frame(fname, engine="numpy", cache=cache)
+    assert not b.flags.writeable
+    r = cbf.read_frame(fname, engine="numpy", roi=(slice(0, 2),), cache=cache)
+    assert np.all(r == a[:2])
+    d = cache.asdict()
+    assert d["evictions"] == 1 and d["frames"] == 1
+    assert d["nbytes"] == r.nbytes
+    # Keys from read_frame and from CBF.get_binary of the same value
+    name = cbf.read_header(fname)["name"]
+    assert cache.key(fname, None, "array_data", "data", 0, False) \
+        == cache.key(fname, name, "array_data", "data", 0, False)
+
+
+def integrator_test():
+    a = cbf.read_binary("testdata/agbeh_long.cbf")
+    mask = a >= 0
+    integ = cbfinteg.integrator(a.shape, (700.0, 900.0), mask)
+    assert cbfinteg.integrator(a.shape, (700.0, 900.0), mask) is integ
+    y, x = np.indices(a.shape)
+    r = np.sqrt((x + 0.5 - 700.0)**2 + (y + 0.5 - 900.0)**2).astype(int)
+    I = integ.integrate(np.array([a, a]))
+    assert I.shape == (2, integ.nbins)
+    for k in [0, 50, 500]:
+        assert np.allclose(I[1,k], a[(r == k) & mask].mean())
+    sectors = cbfinteg.Integrator(a.shape, (700.0, 900.0), mask, nsectors=4)
+    assert np.allclose(sectors.sums(a).sum(axis=0), integ.sums(a))
+    integ = cbfinteg.Integrator(a.shape, (700.0, 900.0), pixel_size=172e-6,
+        distance=2.0, wavelength=1e-10)
+    assert np.all(np.diff(integ.q) > 0)
+
+
+def convert_test():
+    d = tempfile.mkdtemp()
+    try:
+        fnames = cbfbench.write_synthetic(d, "pilatus300k", 5)
+        out = os.path.join(d, "stack.npy")
+        assert cbfconvert.convert(fnames, out, batch=2, engine="numpy") == 5
+        # Resume as if interrupted after two frames
+        f = open(cbfconvert.progress_file(out), "w")
+        for fname in fnames[:2]:
+            f.write(cbfconvert.json.dumps({"filename" :
+                os.path.basename(fname), "header" : {"frame" : "x"}}) + "\n")
+        f.close()
+        assert cbfconvert.convert(fnames, out, batch=2, engine="numpy") == 3
+        assert not os.path.exists(cbfconvert.progress_file(out))
+        stack = np.load(out)
+        for i, fname in enumerate(fnames):
+            assert np.all(stack[i] == cbf.read_binary(fname))
+        meta = np.load(os.path.join(d, "stack.meta.npz"))
+        assert meta["frame"].tolist() == [b"x", b"x", b"2", b"3", b"4"]
+        assert meta["pixel_size"].shape == (5, 2)
+    finally:
+        shutil.rmtree(d)
+
+
+def frame_stats_test():
+    fname = "testdata/agbeh_long.cbf"
+    a = cbf.read_binary(fname)
+    mask = np.zeros(a.shape, dtype=bool)
+    mask[:10] = True
+    st = list(cbfdump.iter_stats([fname, fname], mask, workers=2,
+        engine="numpy"))
+    assert st[0] == st[1]
+    assert st[0]["shape"] == "1679x1475" and st[0]["dtype"] == "int32"
+    assert (st[0]["min"], st[0]["max"]) == (a.min(), a.max())
+    assert st[0]["sum"] == a.sum(dtype=np.int64)
+    assert st[0]["masked_sum"] == a[:10].sum()
+    d = tempfile.mkdtemp()
+    try:
+        for fmt in ["csv", "json"]:
+            f = open(os.path.join(d, "stats"), "w")
+            cbfdump.write_stats(st, fmt, f)
+            f.close()
+            lines = open(os.path.join(d, "stats")).read().splitlines()
+            assert len(lines) == (3 if fmt == "csv" else 2)
+    finally:
+        shutil.rmtree(d)
+
+
+def verify_test():
+    d = tempfile.mkdtemp()
+    try:
+        bad = os.path.join(d, "bad.cbf")
+        shutil.copy("testdata/agbeh_long.cbf", bad)
+        p = cbf.read_header(bad)["parameters"]
+        f = open(bad, "r+b")
+        f.seek(p["offset"] + 1000)
+        f.write(b"\x05")
+        f.close()
+        empty = os.path.join(d, "empty.cbf")
+        open(empty, "w").close()
+        assert cbf.verify(["testdata/agbeh_long.cbf", bad, empty],
+            workers=2) == [True, False, False]
+        cbf.read_binary("testdata/agbeh_long.cbf", verify=True)
+        cbf.read_binary(bad)
+        try:
+            cbf.read_binary(bad, verify=True)
+        except RuntimeError as e:
+            assert e.args[0] == cbf.Errors.CBF_FORMAT
+        else:
+            assert False
+        # Frames cached without verification are verified when asked
+        cache = cbf.FrameCache()
+        cbf.read_frame(bad, "numpy", cache=cache)
+        reads = [
+            lambda: cbf.read_frame(bad, "numpy", cache=cache, verify=True),
+            lambda: cbf.read_binary(bad, sparse=True, verify=True),
+            ]
+        for read in reads:
+            try:
+                read()
+            except RuntimeError as e:
+                assert e.args[0] == cbf.Errors.CBF_FORMAT
+            else:
+                assert False
+    finally:
+        shutil.rmtree(d)
+
+
+def sparse_test():
+    a = cbf.read_binary("testdata/agbeh_long.cbf")
+    sp = cbf.read_binary("testdata/agbeh_long.cbf", sparse=True)
+    assert sp.nnz == np.count_nonzero(a)
+    assert sp.indices.dtype == np.int32
+    assert np.all(sp.toarray() == a)
+    big = np.ones((a.shape[0], a.shape[1] + 3), dtype=a.dtype)
+    sp.toarray(out=big[:,3:])
+    assert np.all(big[:,3:] == a) and np.all(big[:,:3] == 1)
+    row, col = sp.coords()
+    assert np.all(a[row, col] == sp.values)
+    raw = cbf.map_file("testdata/agbeh_long.cbf")
+    p = next(cbf.binary_sections(raw))
+    small = cbf.decode_sparse(raw, p, chunksize=1000)
+    assert np.all(small.indices == sp.indices)
+    stack = cbf.SparseStack()
+    stack.append(sp)
+    stack.append(a[::-1])
+    assert len(stack) == 2
+    assert np.all(stack.frame_counts() == sp.nnz)
+    assert np.all(stack.sum() == a + a[::-1])
+    assert np.all(stack.toarray()[1] == a[::-1])
+
+
+def binned_test():
+    fname = "testdata/agbeh_long.cbf"
+    a = cbf.read_binary(fname).astype(np.int64)
+    raw = cbf.map_file(fname)
+    p = next(cbf.binary_sections(raw))
+    for b in [(2, 2), (3, 5)]:
+        ny, nx = a.shape[0] // b[0], a.shape[1] // b[1]
+        ref = a[:ny*b[0],:nx*b[1]].reshape(ny, b[0], nx, b[1])
+        ref = ref.sum(axis=3).sum(axis=1)
+        assert np.all(cbf.decode_binned(raw, p, b, chunksize=1000) == ref)
+    s = cbf.read_stack([fname]*2, engine="numpy", bin=(4, 4), binmode="mean")
+    assert s.shape == (2, 419, 368) and s.dtype == np.float64
+    assert np.allclose(s[1], a[:1676,:1472].reshape(419, 4, 368, 4).mean(
+        axis=3).mean(axis=1))
+    m = cbfdump.bin_mask(np.ones(a.shape, dtype=bool), 4)
+    assert m.shape == (419, 368) and m.all()
+
+
+def pipeline_test():
+    import cbfpipe
+    d = tempfile.mkdtemp()
+    try:
+        fnames = cbfbench.write_synthetic(d, "pilatus300k", 6)
+        pipe = cbfpipe.Pipeline(fnames, nslots=2, workers=2, engine="numpy")
+        seen = []
+        for i, fname, a in pipe:
+            assert fname == fnames[i]
+            assert np.all(a == cbf.read_binary(fname))
+            seen.append(i)
+        assert sorted(seen) == list(range(6))
+        st = pipe.ring.asdict()
+        assert st["frames"] == 6 and st["occupied"] == 0
+        assert 1 <= st["max_occupied"] <= 2
+        pipe = cbfpipe.Pipeline(fnames + [os.path.join(d, "missing.cbf")],
+            nslots=2, workers=1, engine="numpy")
+        try:
+            for x in pipe:
+                pass
+            assert False
+        except IOError:
+            pass
+        # Stopping early lets the workers exit by themselves
+        pipe = cbfpipe.Pipeline(fnames, nslots=1, workers=2, engine="numpy")
+        procs = list(pipe._procs)
+        for x in pipe:
+            break
+        pipe.close()
+        assert [proc.exitcode for proc in procs] == [0, 0]
+        assert pipe.ring.asdict()["frames"] >= 1
+        # A killed worker does not leave the consumer waiting
+        pipe = cbfpipe.Pipeline(fnames, nslots=1, workers=1, engine="numpy",
+            poll=0.1)
+        pipe._procs[0].terminate()
+        try:
+            for x in pipe:
+                pass
+            assert False
+        except RuntimeError:
+            pass
+    finally:
+        shutil.rmtree(d)
+
+
+def binary_dtype_test():
+    p = {"realarray" : 1, "elsigned" : 1, "elunsigned" : 0, "elsize" : 4}
+    assert cbf.binary_dtype(p) == np.float64
+    assert cbf.binary_dtype(p, native=True) == np.float32
+    p = {"realarray" : 0, "elsigned" : 0, "elunsigned" : 1, "elsize" : 2}
+    assert cbf.binary_dtype(p) == np.uint32
+    assert cbf.binary_dtype(p, native=True) == np.uint16
+
+
+def decode_byte_offset_test():
+    # Deltas 1, 128, -128, 40000, 2**32. The 16-bit payloads of the
+    # second and third delta contain the escape byte 0x80.
+    data = b"\x01\x80\x80\x00\x80\x80\xff" \
+        + b"\x80\x00\x80\x40\x9c\x00\x00" \
+        + b"\x80\x00\x80\x00\x00\x00\x80\x00\x00\x00\x00\x01\x00\x00\x00"
+    a = cbf.decode_byte_offset(data, 5, dtype=np.int64)
+    assert a.tolist() == [1, 129, 1, 40001, 40001 + 2**32]
+
+
+def _decode_byte_offset_scalar(data):
+    import struct
+    out, i, v = [], 0, 0
+    while i < len(data):
+        d = struct.unpack("<b", data[i:i+1])[0]
+        i += 1
+        for fmt, size, esc in [("<h", 2, -128), ("<i", 4, -0x8000),
+                ("<q", 8, -0x80000000)]:
+            if d != esc:
+                break
+            d = struct.unpack(fmt, data[i:i+size])[0]
+            i += size
+        v += d
+        out.append(v)
+    return out
+
+
+def byte_offset_escapes_test():
+    # Frames where most deltas are escaped, and payloads are often 0x80
+    rs = np.random.RandomState(0)
+    frames = [
+        rs.randint(0, 5000, (97, 89)),
+        np.cumsum(np.repeat(-0x7f80, 3001)),
+        np.cumsum(rs.choice([1, 128, -128, -0x7f80, 0x8000, 2**31, -2**40],
+            5000)),
+        ]
+    for a in frames:
+        a = a.astype(np.int64)
+        data = cbf.encode_byte_offset(a)
+        d = cbf.decode_byte_offset(data, a.size, dtype=np.int64)
+        assert d.tolist() == _decode_byte_offset_scalar(data)
+        assert np.all(d == a.reshape(-1))
+        chunks = cbf._iter_byte_offset(data, a.size, chunksize=100)
+        assert np.all(np.concatenate(list(chunks)) == a.reshape(-1))
+    try:
+        cbf.decode_byte_offset(b"\x01\x80\x00", 2)
+        assert False
+    except RuntimeError:
+        pass
+
+
 def iteration_test():
     h = cbf.CBF()
     h.read_file("testdata/agbeh_long.cbf")